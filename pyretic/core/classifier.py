@@ -308,22 +308,28 @@ class Classifier(object):
 
     ### NEGATE ###
     def __invert__(self):
+        return self.invert_actions()
+
+    def invert_actions(self):
+        """Return a classifier with each rule's actions flipped between
+        drop (no actions) and identity, reusing the rule matches. Only
+        filter classifiers can be inverted; any other action set raises.
+        Rules are built directly instead of copy.copy-ing and patching,
+        and the identity test avoids allocating a comparison set per
+        rule.
+        """
         from pyretic.core.language import identity
         new_rules = list()
+        append = new_rules.append
         for r in self.rules:
-            r_new = copy.copy(r)
-            if len(r.actions) == 0:
-                r_new.actions = {identity}
-            elif r.actions == {identity}:
-                r_new.actions = set()
+            acts = r.actions
+            if len(acts) == 0:
+                append(Rule(r.match, {identity}, [r], "negate"))
+            elif len(acts) == 1 and identity in acts:
+                append(Rule(r.match, set(), [r], "negate"))
             else:
                 raise TypeError  # TODO MAKE A CompileError TYPE
-            r_new.parents = [r]
-            r_new.op = "negate"
-            new_rules.append(r_new)
-        c = Classifier(new_rules)
-
-        return c
+        return Classifier(new_rules)
 
 
     ### PARALLEL COMPOSITION
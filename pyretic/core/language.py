@@ -32,8 +32,11 @@
 # This module is designed for import *.
 import functools
 import itertools
+import operator
 import struct
+import threading
 import time
+import weakref
 from ipaddr import IPv4Network
 from bitarray import bitarray
 import logging
@@ -46,6 +49,7 @@ from pyretic.core.netkat import netkat_backend, NETKAT_PORT
 from pyretic.evaluations import stat
 
 from multiprocessing import Lock, Condition
+from collections import deque, OrderedDict
 import copy
 
 NO_CACHE=False
@@ -61,6 +65,70 @@ location_headers = ["switch", "port"]
 compilable_headers = native_headers + location_headers
 content_headers = [ "raw", "header_len", "payload_len"]
 
+# Frozen views of the header lists for fast membership and subset tests.
+compilable_header_set = frozenset(compilable_headers)
+tagging_helper_header_set = frozenset(tagging_helper_headers)
+
+# Process-wide classifier cache shared across structurally-equal policy
+# subtrees.  Dynamic policies rebuild large trees (flood, edge_network)
+# containing many identical subpolicies; keying compiled classifiers on a
+# structural key lets those subtrees compile once.  Values are held
+# weakly, so entries disappear once no policy references the classifier.
+_shared_classifier_cache = weakref.WeakValueDictionary()
+
+# Flyweight table for interned match policies, keyed on the match's
+# field map. Dynamic policies rebuild predicate lists with identical
+# contents on every topology update; interning lets those rebuilds
+# reuse the same instances (and thus their cached classifiers).
+_match_intern = {}
+
+def _interned_match(**kwargs):
+    """ Flyweight constructor for match: calls with equal keyword maps
+    return the same instance. Falls back to a plain match if any value
+    is unhashable. """
+    try:
+        key = frozenset(kwargs.iteritems())
+    except TypeError:
+        return match(**kwargs)
+    m = _match_intern.get(key)
+    if m is None:
+        m = _match_intern[key] = match(**kwargs)
+    return m
+
+class _PktBufPool(threading.local):
+    """ Thread-local freelist of scratch lists for the combinator eval
+    hot path, so per-packet evaluation reuses buffers instead of
+    allocating a fresh accumulator list per call. Buffers are returned
+    cleared; holders must not retain references past release(). """
+    def __init__(self):
+        self.free = []
+
+    def acquire(self):
+        if self.free:
+            return self.free.pop()
+        return []
+
+    def release(self, buf):
+        del buf[:]
+        self.free.append(buf)
+
+_pkt_buf_pool = _PktBufPool()
+
+def _lookup_shared_classifier(pol):
+    """ Compile pol, reusing the classifier of a structurally-equal policy
+    if one is still alive in the shared cache. """
+    try:
+        key = pol._structural_key()
+        classifier = _shared_classifier_cache.get(key)
+        if classifier is None:
+            classifier = pol.generate_classifier()
+            _shared_classifier_cache[key] = classifier
+        return classifier
+    except TypeError:
+        # Unhashable key component, or a classifier that cannot be held
+        # weakly; fall back to compiling without sharing.
+        return pol.generate_classifier()
+
 ################################################################################
 # Policy Language                                                              #
 ################################################################################
@@ -83,10 +151,35 @@ class Policy(object):
         """
         raise NotImplementedError
 
+    def eval_batch(self, pkts):
+        """
+        evaluate this policy on a collection of packets, equivalent to
+        the union of eval over each packet. Subclasses override this
+        where whole-collection evaluation beats per-packet dispatch.
+
+        :param pkts: the packets on which to be evaluated
+        :type pkts: iterable Packet
+        :rtype: set Packet
+        """
+        output = []
+        extend = output.extend
+        for pkt in pkts:
+            extend(self.eval(pkt))
+        return set(output)
+
     def invalidate_classifier(self):
         self._classifier = None
         self.comp_time = 0
 
+    def _structural_key(self):
+        """
+        Hashable key identifying this policy up to structural equality,
+        used to share compiled classifiers across equal subtrees.  The
+        default is the instance itself (identity), which is always safe;
+        structural subclasses (match, modify, combinators) override this.
+        """
+        return self
+
     def has_active_classifier(self):
         return True if self._classifier else False
 
@@ -109,10 +202,24 @@ class Policy(object):
         :rtype: Parallel
         """
         if isinstance(pol,parallel):
-            return parallel([self] + pol.policies)
+            return parallel(_PolicyRope([self], pol._policies))
         else:
             return parallel([self, pol])
 
+    def __radd__(self, other):
+        """
+        Support sum() over policies. Repeated binary composition copies
+        the accumulated policy list at every step; builders of long
+        combinations should prefer parallel(pols)/sequential(pols),
+        which build the combinator in one allocation.
+
+        :param other: the value to the left of the operator
+        :rtype: Policy
+        """
+        if isinstance(other, (int, long)) and other == 0:
+            return self
+        return NotImplemented
+
     def __rshift__(self, other):
         """
         The sequential composition operator.
@@ -122,7 +229,7 @@ class Policy(object):
         :rtype: Sequential
         """
         if isinstance(other,sequential):
-            return sequential([self] + other.policies)
+            return sequential(_PolicyRope([self], other._policies))
         else:
             return sequential([self, other])
 
@@ -265,6 +372,9 @@ class Singleton(Filter):
     """Abstract policy from which Singletons descend"""
 
     _classifier = None
+    # Serializes first-time classifier generation across threads, so
+    # concurrent compiles observe one classifier instance per class.
+    _classifier_lock = Lock()
     __metaclass__ = SingletonMetaclass
 
     def compile(self):
@@ -273,15 +383,20 @@ class Singleton(Filter):
 
         :rtype: Classifier
         """
-        if NO_CACHE: 
+        if NO_CACHE:
             self.__class__._classifier = self.generate_classifier()
         if self.__class__._classifier is None:
-            self.__class__._classifier = self.generate_classifier()
+            with Singleton._classifier_lock:
+                if self.__class__._classifier is None:
+                    self.__class__._classifier = self.generate_classifier()
         return self.__class__._classifier
 
     def generate_classifier(self):
         return Classifier([Rule(identity, {self}, [self])])
 
+    def _structural_key(self):
+        return self.__class__
+
 class IdentityClass(Singleton):
     """The identity policy, leaves all packets unchanged."""
     def eval(self, pkt):
@@ -383,6 +498,8 @@ class match(Filter):
             return map_dict
 
         self.map = util.frozendict(_get_processed_map(*args, **kwargs))
+        self._hash = hash(self.map)
+        self._keyset = frozenset(self.map.keys())
         self._classifier = self.generate_classifier()
         super(match,self).__init__()
 
@@ -394,16 +511,32 @@ class match(Filter):
         :type pkt: Packet
         :rtype: set Packet
         """
-        return _match(**self.map).eval(pkt)
+        return self.internal_match.eval(pkt)
+
+    def eval_batch(self, pkts):
+        """
+        evaluate this policy on a collection of packets at once
+
+        :param pkts: the packets on which to be evaluated
+        :type pkts: iterable Packet
+        :rtype: set Packet
+        """
+        return self.internal_match.eval_batch(pkts)
 
     def generate_classifier(self):
-        c = _match(**self.map).generate_classifier()
+        # Build the inner _match only once; it is immutable and shared by
+        # eval, so per-packet evaluation avoids reconstructing it.
         self.internal_match = _match(**self.map)
-        return c
+        return self.internal_match.generate_classifier()
 
     def __eq__(self, other):
-        return ( (isinstance(other, match) and self.map == other.map)
-                 or (len(self.map) == 0 and other == identity) )
+        if self is other:
+            return True
+        if isinstance(other, match):
+            # Unequal cached hashes imply unequal maps, so the common
+            # mismatch case skips the full map comparison.
+            return self._hash == other._hash and self.map == other.map
+        return len(self.map) == 0 and other == identity
 
     def intersect(self, pol):
         def _intersect_ip(ipfx, opfx):
@@ -422,9 +555,9 @@ class match(Filter):
             return drop
         elif not isinstance(pol,match):
             raise TypeError
-        fs1 = set(self.map.keys())
-        fs2 = set(pol.map.keys())
-        shared = fs1 & fs2
+        # Key sets are precomputed at construction; disjoint matches
+        # skip straight to the merge below.
+        shared = self._keyset & pol._keyset
         most_specific_src = None
         most_specific_dst = None
 
@@ -440,12 +573,15 @@ class match(Filter):
             elif (self.map[f] != pol.map[f]):
                 return drop
 
-        d = self.map.update(pol.map)
+        # Merge in one plain dict rather than chaining frozendict
+        # updates, each of which copies the whole map.
+        d = dict(self.map.iteritems())
+        d.update(pol.map.iteritems())
 
         if most_specific_src is not None:
-            d = d.update({'srcip' : most_specific_src})
+            d['srcip'] = most_specific_src
         if most_specific_dst is not None:
-            d = d.update({'dstip' : most_specific_dst})
+            d['dstip'] = most_specific_dst
 
         return match(**d)
 
@@ -457,7 +593,10 @@ class match(Filter):
 
     ### hash : unit -> int
     def __hash__(self):
-        return hash(self.map)
+        return self._hash
+
+    def _structural_key(self):
+        return (self.__class__, self.map)
 
     def covers(self,other):
         # Return identity if self matches every packet that other matches (and maybe more).
@@ -493,11 +632,95 @@ class match(Filter):
     def __repr__(self):
         return "match: %s" % ' '.join(map(str,self.internal_match.map.items()))
 
+# Sentinel distinguishing "header absent" from any real header value.
+_MISSING = object()
+
+_vf_translation_cache = {}
+
+def _translate_virtual_fields(fmap):
+    """Translate the virtual fields in fmap into VLAN-encoded compilable
+    headers, returning a plain dict. The translation is deterministic
+    given the field map and the set of registered virtual fields, so
+    results are memoized keyed on both; the registry version guards
+    against fields registered after a translation was cached.
+    """
+    from pyretic.core.runtime import abstract_virtual_field as avf
+    try:
+        key = (frozenset(fmap.iteritems()), avf.registry_version)
+        return _vf_translation_cache[key]
+    except KeyError:
+        pass
+    except TypeError:
+        key = None
+
+    _map = {f: p for (f, p) in fmap.iteritems()
+            if f in compilable_header_set}
+    _vf  = {f: p for (f, p) in fmap.iteritems()
+            if f not in compilable_header_set}
+
+    if _vf:
+        vcls = list(set([avf.get_class(x) for x in _vf.keys()]))
+        assert len(vcls) == 1, "can't mix multiple virt header types!"
+        assert not vcls[0] is None, "not a defined virtual field: %s" % x
+        vcls = vcls[0]
+    else:
+        vcls = avf
+
+    _map.update(
+      vcls.map_to_vlan(
+        vcls.compress(_vf)))
+
+    if key is not None:
+        _vf_translation_cache[key] = _map
+    return _map
+
+
 class _match(match):
     def __init__(self, *args, **kwargs):
         super(_match,self).__init__(*args, **kwargs)
 
         self.map = self.translate_virtual_fields()
+        self._hash = hash(self.map)
+        self._keyset = frozenset(self.map.keys())
+        # Precompute per-packet evaluation state: a plain tuple of
+        # (field, pattern) pairs avoids re-iterating the frozendict on
+        # every eval, and the VLAN value/mask pair is constant for a
+        # given match so it is computed once here.
+        self._items = tuple(self.map.iteritems())
+        # Pack IP prefixes into (network, netmask) integer pairs so the
+        # per-packet containment test is two int ops instead of an
+        # IPv4Network.__contains__ call. None marks patterns that can
+        # never match (or are wildcarded; eval distinguishes via the
+        # original pattern).
+        self._packed_ips = {}
+        for field in ('srcip', 'dstip'):
+            if field in self.map:
+                pattern = self.map[field]
+                try:
+                    self._packed_ips[field] = (int(pattern.network),
+                                               int(pattern.netmask))
+                except Exception:
+                    self._packed_ips[field] = None
+        self._vlan_check = None
+        if 'vlan_id' in self.map:
+            try:
+                fmap = self.map
+                assert 'vlan_pcp' in fmap, "Incorrect VLAN setting."
+                assert 'vlan_offset' in fmap, "Incorrect VLAN setting."
+                assert 'vlan_nbits' in fmap, "Incorrect VLAN setting."
+                vlan_16bit = (fmap['vlan_id'] | (fmap['vlan_pcp'] << 12))
+                mask = (((1 << fmap['vlan_nbits']) - 1) <<
+                        fmap['vlan_offset'])
+                self._vlan_check = (vlan_16bit, mask)
+            except Exception:
+                # Leave _vlan_check unset; eval's exception handling
+                # reproduces the original per-packet failure behavior.
+                pass
+        # Specialize eval per pattern: each field compiles to a closure
+        # with its type dispatch (prefix, VLAN, equality) resolved here
+        # at construction, so the per-packet loop just calls checks.
+        self._checks = tuple(self._compile_field_check(field, pattern)
+                             for (field, pattern) in self._items)
 
     def generate_classifier(self):
         r1 = Rule(self,{identity},[self])
@@ -516,58 +739,134 @@ class _match(match):
         m.pop("vlan_total_stages", None)
         return _match(**m)
 
+    def _compile_field_check(self, field, pattern):
+        """Return a pkt -> bool closure testing this field against its
+        pattern. The field-type dispatch runs once here; the returned
+        closures reproduce eval's original semantics, including
+        missing-field handling (helper headers and None patterns pass,
+        everything else fails). Absent headers are detected with a
+        sentinel get rather than exception handling, so the common
+        miss costs no exception setup/teardown.
+        """
+        if field in ('srcip', 'dstip'):
+            packed = self._packed_ips[field]
+            string_to_IP = util.string_to_IP
+            def check(pkt):
+                v = pkt.header.get(field, _MISSING)
+                if v is _MISSING:
+                    return pattern is None
+                if packed is None:
+                    return False
+                try:
+                    return (int(string_to_IP(v)) & packed[1]) == packed[0]
+                except Exception:
+                    return pattern is None
+        elif field == 'vlan_id':
+            vlan_check = self._vlan_check
+            def check(pkt):
+                v = pkt.header.get(field, _MISSING)
+                if v is _MISSING or vlan_check is None:
+                    return pattern is None
+                (vlan_16bit, mask) = vlan_check
+                return (vlan_16bit & mask) == (v & mask)
+        elif field in ('vlan_pcp', 'vlan_offset', 'vlan_nbits'):
+            has_vlan_id = 'vlan_id' in self.map
+            passes_when_absent = (field in tagging_helper_header_set
+                                  or pattern is None)
+            def check(pkt):
+                if pkt.header.get(field, _MISSING) is _MISSING:
+                    return passes_when_absent
+                return has_vlan_id or passes_when_absent
+        else:
+            passes_when_absent = (field in tagging_helper_header_set
+                                  or pattern is None)
+            def check(pkt):
+                v = pkt.header.get(field, _MISSING)
+                if v is _MISSING:
+                    return passes_when_absent
+                return pattern is not None and pattern == v
+        return check
+
     def eval(self,pkt):
-        for field, pattern in self.map.iteritems():
-            try:
-                v = pkt[field]
-                if field in ['srcip', 'dstip']:
-                    v = util.string_to_IP(v)
-                    if pattern is None or not v in pattern:
-                        return set()
-                elif field == 'vlan_id':
-                    assert 'vlan_pcp' in self.map, "Incorrect VLAN setting."
-                    assert 'vlan_offset' in self.map, "Incorrect VLAN setting."
-                    assert 'vlan_nbits' in self.map, "Incorrect VLAN setting."
-                    fmap = self.map
-                    vlan_16bit = (fmap['vlan_id'] | (fmap['vlan_pcp'] << 12))
-                    mask = (((1 << fmap['vlan_nbits']) - 1) <<
-                            fmap['vlan_offset'])
-                    if (vlan_16bit & mask) != (v & mask):
-                        return set()
-                elif field in ['vlan_pcp', 'vlan_offset', 'vlan_nbits']:
-                    assert 'vlan_id' in self.map, "Incorrect VLAN setting."
-                else:
-                    if pattern is None or pattern != v:
-                        return set()
-            except Exception, e:
-                if (not field in tagging_helper_headers) and pattern is not None:
-                    return set()
+        for check in self._checks:
+            if not check(pkt):
+                return set()
         return {pkt}
 
-    def translate_virtual_fields(self):
-        from pyretic.core.runtime import abstract_virtual_field as avf
-        _map = {}
-        _vf  = {}
+    def eval_batch(self, pkts):
+        """Field-major counterpart to eval for packet batches.
 
-        for field, pattern in self.map.iteritems():
-            if field in compilable_headers:
-                _map[field] = pattern
+        Each field's dispatch (prefix containment, VLAN masking, plain
+        equality) is resolved once per field and applied across all
+        surviving packets, rather than once per packet and field as in
+        the scalar eval. Returns the set of packets that match.
+        """
+        survivors = list(pkts)
+        for field, pattern in self._items:
+            if not survivors:
+                break
+            if field in ('srcip', 'dstip'):
+                packed = self._packed_ips[field]
+                string_to_IP = util.string_to_IP
+                kept = []
+                for pkt in survivors:
+                    v = pkt.header.get(field, _MISSING)
+                    if v is _MISSING:
+                        if pattern is None:
+                            kept.append(pkt)
+                        continue
+                    try:
+                        v_int = int(string_to_IP(v))
+                    except Exception:
+                        if pattern is None:
+                            kept.append(pkt)
+                        continue
+                    if packed is not None and (v_int & packed[1]) == packed[0]:
+                        kept.append(pkt)
+                survivors = kept
+            elif field == 'vlan_id':
+                vlan_check = self._vlan_check
+                kept = []
+                for pkt in survivors:
+                    v = pkt.header.get(field, _MISSING)
+                    if v is _MISSING or vlan_check is None:
+                        if pattern is None:
+                            kept.append(pkt)
+                        continue
+                    (vlan_16bit, mask) = vlan_check
+                    if (vlan_16bit & mask) == (v & mask):
+                        kept.append(pkt)
+                survivors = kept
+            elif field in ('vlan_pcp', 'vlan_offset', 'vlan_nbits'):
+                has_vlan_id = 'vlan_id' in self.map
+                passes_when_absent = (field in tagging_helper_header_set
+                                      or pattern is None)
+                if has_vlan_id and passes_when_absent:
+                    continue
+                kept = []
+                for pkt in survivors:
+                    if pkt.header.get(field, _MISSING) is _MISSING:
+                        if passes_when_absent:
+                            kept.append(pkt)
+                    elif has_vlan_id or passes_when_absent:
+                        kept.append(pkt)
+                survivors = kept
             else:
-                _vf[field] = pattern
+                optional = field in tagging_helper_header_set
+                kept = []
+                for pkt in survivors:
+                    v = pkt.header.get(field, _MISSING)
+                    if v is _MISSING:
+                        if optional or pattern is None:
+                            kept.append(pkt)
+                        continue
+                    if pattern is not None and pattern == v:
+                        kept.append(pkt)
+                survivors = kept
+        return set(survivors)
 
-        if _vf:
-            vcls = list(set([avf.get_class(x) for x in _vf.keys()]))
-            assert len(vcls) == 1, "can't mix multiple virt header types!"
-            assert not vcls[0] is None, "not a defined virtual field: %s" % x
-            vcls = vcls[0]
-        else:
-            vcls = avf
-
-        _map.update(
-          vcls.map_to_vlan(
-            vcls.compress(_vf)))
-
-        return util.frozendict(**_map)
+    def translate_virtual_fields(self):
+        return util.frozendict(_translate_virtual_fields(self.map))
 
     def __repr__(self):
         return "match: %s" % ' '.join(map(str,self.map.items()))
@@ -580,17 +879,16 @@ class modify(Policy):
     :param *args: field assignments in argument format
     :param **kwargs: field assignments in keyword-argument format
     """
+    _hash = None
+
     ### init : List (String * FieldVal) -> List KeywordArg -> unit
     def __init__(self, *args, **kwargs):
         #TODO(Josh, Cole): why this check is here?
         #if len(args) == 0 and len(kwargs) == 0:
         #    raise TypeError
         self.map = dict(*args, **kwargs)
-        self.has_virtual_headers = not \
-            reduce(lambda acc, f:
-                       acc and (f in compilable_headers),
-                   self.map.keys(),
-                   True)
+        self.has_virtual_headers = not (
+            set(self.map.keys()) <= compilable_header_set)
         self._classifier = self.generate_classifier()
         super(modify,self).__init__()
 
@@ -602,12 +900,12 @@ class modify(Policy):
         :type pkt: Packet
         :rtype: set Packet
         """
-        return _modify(**self.map).eval(pkt)
+        return self.internal_modify.eval(pkt)
 
     def generate_classifier(self):
-        c = _modify(**self.map).generate_classifier()
+        # As in match, build the inner _modify once and reuse it in eval.
         self.internal_modify = _modify(**self.map)
-        return c
+        return self.internal_modify.generate_classifier()
 
 
     def __repr__(self):
@@ -617,6 +915,19 @@ class modify(Policy):
         return ( isinstance(other, modify)
            and (self.map == other.map) )
 
+    ### hash : unit -> int
+    def __hash__(self):
+        # Lazily computed (rather than in __init__) since _modify
+        # replaces self.map with its virtual-field translation after
+        # construction.
+        h = self._hash
+        if h is None:
+            h = self._hash = hash(frozenset(self.map.items()))
+        return h
+
+    def _structural_key(self):
+        return (self.__class__, frozenset(self.map.items()))
+
 class _modify(modify):
     def __init__(self, *args, **kwargs):
         super(_modify,self).__init__(*args, **kwargs)
@@ -678,29 +989,9 @@ class _modify(modify):
             return {updated_pkt}
 
     def translate_virtual_fields(self):
-        from pyretic.core.runtime import abstract_virtual_field as avf
-        _map = {}
-        _vf  = {}
-
-        for field, pattern in self.map.iteritems():
-            if field in compilable_headers:
-                _map[field] = pattern
-            else:
-                _vf[field] = pattern
-
-        if _vf:
-            vcls = list(set([avf.get_class(x) for x in _vf.keys()]))
-            assert len(vcls) == 1, "can't mix multiple virt header types!"
-            assert not vcls[0] is None, "not a defined virtual field: %s" % x
-            vcls = vcls[0]
-        else:
-            vcls = avf
-
-        _map.update(
-          vcls.map_to_vlan(
-            vcls.compress(_vf)))
-
-        return _map
+        # Copy the memoized translation: _modify maps stay plain dicts
+        # and downstream code copies/mutates them.
+        return dict(_translate_virtual_fields(self.map))
 
     def __repr__(self):
         return "modify: %s" % ' '.join(map(str,self.map.items()))
@@ -716,7 +1007,8 @@ class Query(Filter):
     def __init__(self):
         from multiprocessing import Lock
         self.callbacks = []
-        self.bucket = set()
+        self.batch_callbacks = []
+        self.bucket = deque()
         self.bucket_lock = Lock()
         super(Query,self).__init__()
 
@@ -728,10 +1020,10 @@ class Query(Filter):
         :type pkt: Packet
         :rtype: set Packet
         """
-          
+
         with self.bucket_lock:
-            self.bucket.add(pkt)
-            
+            self.bucket.append(pkt)
+
             '''print "-------- in bucket eval ----------"
             print id(self)
             print pkt
@@ -740,11 +1032,29 @@ class Query(Filter):
             print '-------- end eval ----------'
             '''
         return set()
-        
+
+    def swap_bucket(self):
+        """Atomically take the accumulated packets for processing,
+        leaving an empty bucket in place. Consumers iterate the
+        returned container outside bucket_lock, so producers are only
+        blocked for the duration of the swap.
+        """
+        with self.bucket_lock:
+            (drained, self.bucket) = (self.bucket, deque())
+        return drained
+
     ### register_callback : (Packet -> X) -> unit
     def register_callback(self, fn):
         self.callbacks.append(fn)
 
+    ### register_batch_callback : (set Packet -> X) -> unit
+    def register_batch_callback(self, fn):
+        """Register a callback invoked once per drained batch with the
+        full set of packets, rather than once per packet. Amortizes
+        Python call overhead for consumers that can handle batches.
+        """
+        self.batch_callbacks.append(fn)
+
     def __repr__(self):
         return "Query"
 
@@ -763,12 +1073,17 @@ class FwdBucket(Query):
         return Classifier([Rule(identity,{Controller},[self])])
 
     def apply(self):
-        with self.bucket_lock:
-            for pkt in self.bucket:
-                self.log.info('In FwdBucket apply(): packet is:\n' + str(pkt))
-                for callback in self.callbacks:
-                    callback(pkt)
-            self.bucket.clear()
+        pkts = self.swap_bucket()
+        if not pkts:
+            return
+        for pkt in pkts:
+            # Lazy %-style formatting: logging skips str(pkt) entirely
+            # when INFO is disabled.
+            self.log.info('In FwdBucket apply(): packet is:\n%s', pkt)
+            for callback in self.callbacks:
+                callback(pkt)
+        for callback in self.batch_callbacks:
+            callback(pkts)
     
     def __repr__(self):
         return "FwdBucket %s" % str(id(self))
@@ -796,18 +1111,16 @@ class PathBucket(FwdBucket):
         return Classifier([Rule(identity,{self},[self])])
 
     def apply(self, original_pkt=None):
-        with self.bucket_lock:
-            packet_set = set()
-            if self.require_original_pkt and original_pkt:
-                packet_set.add(original_pkt)
-            else:
-                packet_set = self.bucket
-            for pkt in packet_set:
-                self.log.info('In PathBucket apply(): packet is:\n' + str(pkt))
-                paths = self.get_trajectories(pkt)
-                for callback in self.callbacks:
-                    callback(pkt, paths)
-            self.bucket.clear()
+        drained = self.swap_bucket()
+        if self.require_original_pkt and original_pkt:
+            packet_set = [original_pkt]
+        else:
+            packet_set = drained
+        for pkt in packet_set:
+            self.log.info('In PathBucket apply(): packet is:\n' + str(pkt))
+            paths = self.get_trajectories(pkt)
+            for callback in self.callbacks:
+                callback(pkt, paths)
 
     def set_topology_policy_fun(self, topo_pol_fun):
         self.runtime_topology_policy_fun = topo_pol_fun
@@ -834,23 +1147,37 @@ class PathBucket(FwdBucket):
             denoting the trajectory of the input packet at switch ingresses,
             except for the last element of the packet path which denotes packet
             state at network egress.
+
+            Implemented as an explicit depth-first traversal rather than
+            recursion, so long trajectories neither pay a Python call
+            frame per hop nor risk hitting the recursion limit.
             """
             at_egress = egress.eval(pkt)
             if len(at_egress) == 1: # the pkt is already at network egress
                 return [pkt]
 
-            # Move packet one hop, then recursively enumerate paths.
-            pkts_moved = (fwding >> topo).eval(pkt)
-            full_paths = []
-            for p in pkts_moved:
-                suffix_paths = packet_paths(p, topo, fwding, egress)
-                for sp in suffix_paths:
-                    full_paths.append([pkt] + sp)
+            # Compose the per-hop policies once; the compositions are
+            # invariant across the traversal, and building them per
+            # node allocated two fresh sequential policies per hop.
+            hop_policy = fwding >> topo
+            egress_policy = fwding >> egress
 
-            # Move packet one hop, then terminate paths if necessary
-            pkts_egressed = (fwding >> egress).eval(pkt)
-            for p in pkts_egressed:
-                full_paths.append([pkt, p])
+            full_paths = []
+            stack = [(pkt, [])]
+            while stack:
+                (p, prefix) = stack.pop()
+                if len(egress.eval(p)) == 1: # p reached network egress
+                    full_paths.append(prefix + [p])
+                    continue
+                path_to_p = prefix + [p]
+
+                # Move packet one hop, then continue enumerating paths.
+                for moved in hop_policy.eval(p):
+                    stack.append((moved, path_to_p))
+
+                # Move packet one hop, then terminate paths if necessary
+                for egressed in egress_policy.eval(p):
+                    full_paths.append(path_to_p + [egressed])
 
             return full_paths
 
@@ -909,9 +1236,11 @@ class MatchingAggregateBucket(Query):
             self.match = util.frozendict(match)
             self.priority = priority
             self.version = version
+            self._hash = (hash(self.match) ^ hash(self.priority) ^
+                          hash(self.version))
 
         def __hash__(self):
-            return hash(self.match) ^ hash(self.priority) ^ hash(self.version)
+            return self._hash
 
         def __eq__(self,other):
             try:
@@ -932,6 +1261,8 @@ class MatchingAggregateBucket(Query):
                 match, priority, version)
             self.match = util.frozendict(
                 {'switch':match['switch']} if 'switch' in match else {})
+            self._hash = (hash(self.match) ^ hash(self.priority) ^
+                          hash(self.version))
 
     class match_status(object):
         def __init__(self,to_be_deleted=False,existing_rule=False):
@@ -980,9 +1311,19 @@ class CountBucket(MatchingAggregateBucket):
     Class for registering callbacks on counts of packets sent to
     the controller.
     """
+    _ME_CACHE_MAX = 4096
+
     def __init__(self, bname=None):
         self.bname = str(bname) if bname else str(id(self))
         super(CountBucket, self).__init__()
+        # Rule bookkeeping in structure-of-arrays form: one set of rule
+        # entries, plus parallel sets holding the entries whose
+        # to_be_deleted/existing_rule flags are raised. Membership and
+        # flag flips are single set operations instead of per-entry
+        # status-object accesses.
+        self.match_entries = set()
+        self.matches_to_be_deleted = set()
+        self.matches_existing = set()
         self.runtime_stats_query_fun = None
         self.runtime_existing_stats_query_fun = None
         self.outstanding_switches = set()
@@ -1000,6 +1341,11 @@ class CountBucket(MatchingAggregateBucket):
         self.new_bucket = True
         self.max_num_callbacks = 0
         self.max_num_callbacks_lock = Lock()
+        # Interned rule_entry probes keyed on the raw flow-stat contents.
+        # Every polling cycle replays largely the same flow stats, so
+        # reusing the constructed entry avoids an allocation plus match
+        # conversion per stat. Bounded FIFO eviction keeps it small.
+        self._me_cache = OrderedDict()
         self._classifier = self.generate_classifier()
         self.log = logging.getLogger('%s.CountBucket' % __name__)
 
@@ -1013,15 +1359,17 @@ class CountBucket(MatchingAggregateBucket):
         return Classifier([Rule(identity,{self},[self])])
 
     def apply(self):
-        with self.bucket_lock:
-            for pkt in self.bucket:
-                self.log.info('In CountBucket ' + self.bname + ' apply():'
-                               + ' Packet is:\n' + repr(pkt))
-                self.packet_count_persistent += 1
-                self.byte_count_persistent += pkt['payload_len']
-                self.packet_count_persistent_apply += 1
-                self.byte_count_persistent_apply += pkt['payload_len']
-            self.bucket.clear()
+        pkt_count = 0
+        byte_count = 0
+        for pkt in self.swap_bucket():
+            self.log.info('In CountBucket ' + self.bname + ' apply():'
+                           + ' Packet is:\n' + repr(pkt))
+            pkt_count += 1
+            byte_count += pkt['payload_len']
+        self.packet_count_persistent += pkt_count
+        self.byte_count_persistent += byte_count
+        self.packet_count_persistent_apply += pkt_count
+        self.byte_count_persistent_apply += byte_count
         self.log.debug('In bucket ' +  self.bname + ' apply(): ' +
                        'persistent packet count is ' +
                        str(self.packet_count_persistent))
@@ -1087,11 +1435,10 @@ class CountBucket(MatchingAggregateBucket):
             '''
             k = self.rule_entry(self.str_convert_match(match),
                                 priority, version)
-            if k in self.matches:
+            if k in self.match_entries:
                 self.log.debug("Deleted flow exists in the bucket's matches")
-                status = self.matches[k]
-                assert status.to_be_deleted
-                if not status.existing_rule: # Note: If pre-existing rule was
+                assert k in self.matches_to_be_deleted
+                if k not in self.matches_existing: # Note: If pre-existing rule was
                     # removed, then forget that this rule ever
                     # existed. We don't count it.
                     if packet_count > 0:
@@ -1109,7 +1456,9 @@ class CountBucket(MatchingAggregateBucket):
                 # that this rule was ever associated with the bucket
                 # if we get a "flow removed" message before we got
                 # the first ever stats reply from an existing rule.
-                del self.matches[k]
+                self.match_entries.discard(k)
+                self.matches_to_be_deleted.discard(k)
+                self.matches_existing.discard(k)
 
     def add_pull_stats(self, fun):
         """
@@ -1135,7 +1484,7 @@ class CountBucket(MatchingAggregateBucket):
                 # Note: If a query is already in progress, this will wipe out
                 # all its intermediate results for it.
                 self.outstanding_switches = set()
-                self.switches_to_query = set()
+                self.switches_in_query = set()
                 queries_issued = pull_function() # return value denotes whether
                                                  # we expect a stats_reply in
                                                  # future
@@ -1150,18 +1499,19 @@ class CountBucket(MatchingAggregateBucket):
         if not queries_issued:
             self.clear_transient_counters()
             self.log.info("Didn't issue stat queries; directly returning!")
-            self.call_callbacks([self.packet_count_persistent,
-                                 self.byte_count_persistent])
+            self.call_callbacks((self.packet_count_persistent,
+                                 self.byte_count_persistent))
 
     def call_callbacks(self, args):
         """ Pace callbacks according to pull_stats issued by application. """
-        self.log.debug("Max # callback responses left: %d" %
-                        self.max_num_callbacks)
+        self.log.debug("Max # callback responses left: %d",
+                       self.max_num_callbacks)
         with self.max_num_callbacks_lock:
             if self.max_num_callbacks > 0:
                 self.max_num_callbacks -= 1
-                for f in self.callbacks:
-                    f(args)
+                # List comprehension (result discarded) runs the
+                # callback loop at C speed; args is one shared tuple.
+                [f(args) for f in self.callbacks]
 
     def increment_max_num_callbacks(self):
         """ Pace callbacks according to pull_stats issued by application. """
@@ -1205,141 +1555,223 @@ class CountBucket(MatchingAggregateBucket):
         def entries_print_helper(pfx_string=""):
             """ Pretty print bucket match entries. """
             out = ""
-            for k in self.matches.keys():
+            for k in self.match_entries:
                 out += pfx_string + str(k) + "\n"
             return out
 
         def stat_in_bucket(flow_stat, s):
             """Return a matching entry for the given flow_stat in
             bucket.matches."""
-            f = copy.copy(flow_stat['match'])
-            f['switch'] = s
-            ''' To restore using matches, uncomment the following lines.
-            # fme = self.match_entry(self.str_convert_match(f),
-            #                        flow_stat['priority'],
-            #                        flow_stat['cookie'])
-            Note that the change from match_entry to rule_entry implicitly
-            denotes the assumption about the runtime that rules are uniquely
-            identified by their cookie and priority, which denote (1) priority
-            in a given table, (2) the table itself, and (3) the version number
-            of the entire policy.
-            '''
-            fme = self.rule_entry(self.str_convert_match(f),
-                                  flow_stat['priority'],
-                                  flow_stat['cookie'])
-            if fme in self.matches.keys():
+            if (flow_stat['priority'], flow_stat['cookie']) not in pri_ver_index:
+                # No stored entry shares this (priority, version); skip
+                # match conversion and entry construction entirely.
+                return None
+            key = (frozenset(flow_stat['match'].iteritems()),
+                   flow_stat['priority'], flow_stat['cookie'], s)
+            fme = self._me_cache.get(key)
+            if fme is None:
+                f = dict(flow_stat['match'], switch=s)
+                ''' To restore using matches, uncomment the following lines.
+                # fme = self.match_entry(self.str_convert_match(f),
+                #                        flow_stat['priority'],
+                #                        flow_stat['cookie'])
+                Note that the change from match_entry to rule_entry implicitly
+                denotes the assumption about the runtime that rules are
+                uniquely identified by their cookie and priority, which denote
+                (1) priority in a given table, (2) the table itself, and (3)
+                the version number of the entire policy.
+                '''
+                fme = self.rule_entry(self.str_convert_match(f),
+                                      flow_stat['priority'],
+                                      flow_stat['cookie'])
+                self._me_cache[key] = fme
+                if len(self._me_cache) > self._ME_CACHE_MAX:
+                    self._me_cache.popitem(last=False)
+            if fme in self.match_entries:
                 return fme
             return None
 
         self.log.debug("Got a reply from switch %s" % switch)
+        # Snapshot the bucket state needed by the per-stat loop under the
+        # condition variable, then process the (potentially large) reply
+        # without holding it, so replies from different switches don't
+        # serialize on each other. The shard totals accumulated below are
+        # merged into the shared counters in one short critical section.
         with self.in_update_cv:
             while self.in_update:
                 self.log.debug("Waiting for update to finish.")
                 self.in_update_cv.wait()
             self.log.debug("Current set of outstanding switches is:")
             self.log.debug(str(self.outstanding_switches))
-            if switch in self.outstanding_switches:
-                for f in flow_stats:
-                    if 'match' in f:
-                        me = stat_in_bucket(f, switch)
-                        extracted_pkts = f['packet_count']
-                        extracted_bytes = f['byte_count']
-                        if extracted_pkts > 0 and not me:
-                            self.log.debug("Packet not counted: \n%s %s %s" %
-                                           (str(f['match']),
-                                            "priority=%d" % f['priority'],
-                                            "version=%d" % f['cookie']))
-                            self.log.debug("Existing keys: \n%s" %
-                                           entries_print_helper())
-                        if me:
-                            if extracted_pkts > 0:
-                                self.log.debug('In bucket ' + self.bname +
-                                               ': found matching stats_reply:')
-                                self.log.debug(str(me))
-                                self.log.debug('packets: ' +
-                                               str(extracted_pkts) + ' bytes: '
-                                               + str(extracted_bytes))
-                            if not self.matches[me].existing_rule:
-                                self.packet_count_table += extracted_pkts
-                                self.byte_count_table   += extracted_bytes
-                            else: # pre-existing rule when bucket was created
-                                self.log.debug(('In bucket %s: removing' +
-                                                'pre-existing rule counts %d' +
-                                                ' %d') %
-                                               (self.bname, extracted_pkts,
-                                                extracted_bytes ))
-                                self.packet_count_persistent -= extracted_pkts
-                                self.byte_count_persistent -= extracted_bytes
-                                self.packet_count_persistent_existing += (
-                                    extracted_pkts)
-                                self.byte_count_persistent_existing += (
-                                    extracted_bytes)
-                                self.clear_existing_rule_flag(me)
-                    else:
-                        raise RuntimeError("weird flow entry")
-                self.outstanding_switches.remove(switch)
-                self.log.debug("Current set of outstanding switches is:")
-                self.log.debug(str(self.outstanding_switches))
+            relevant = switch in self.outstanding_switches
+            if relevant:
+                pri_ver_index = frozenset((e.priority, e.version)
+                                          for e in self.match_entries)
+        if relevant:
+            # str(me) and the match stringification below are expensive;
+            # check the level once per reply instead of formatting and
+            # discarding per stat when DEBUG is filtered out.
+            _dbg = self.log.isEnabledFor(logging.DEBUG)
+            shard_pkts_table = 0
+            shard_bytes_table = 0
+            shard_pkts_existing = 0
+            shard_bytes_existing = 0
+            cleared_entries = []
+            for f in flow_stats:
+                if 'match' in f:
+                    me = stat_in_bucket(f, switch)
+                    extracted_pkts = f['packet_count']
+                    extracted_bytes = f['byte_count']
+                    if _dbg and extracted_pkts > 0 and not me:
+                        self.log.debug("Packet not counted: \n%s priority=%d"
+                                       " version=%d",
+                                       f['match'], f['priority'], f['cookie'])
+                        self.log.debug("Existing keys: \n%s",
+                                       entries_print_helper())
+                    if me:
+                        if _dbg and extracted_pkts > 0:
+                            self.log.debug('In bucket %s: found matching'
+                                           ' stats_reply:', self.bname)
+                            self.log.debug(str(me))
+                            self.log.debug('packets: %d bytes: %d',
+                                           extracted_pkts, extracted_bytes)
+                        if me not in self.matches_existing:
+                            shard_pkts_table += extracted_pkts
+                            shard_bytes_table += extracted_bytes
+                        else: # pre-existing rule when bucket was created
+                            if _dbg:
+                                self.log.debug('In bucket %s: removing'
+                                               ' pre-existing rule counts'
+                                               ' %d %d', self.bname,
+                                               extracted_pkts,
+                                               extracted_bytes)
+                            shard_pkts_existing += extracted_pkts
+                            shard_bytes_existing += extracted_bytes
+                            cleared_entries.append(me)
+                else:
+                    raise RuntimeError("weird flow entry")
+            with self.in_update_cv:
+                # A concurrent start_update may have wiped the query state
+                # while this shard was being computed; merge only if this
+                # switch's reply is still expected.
+                if switch in self.outstanding_switches:
+                    self.packet_count_table += shard_pkts_table
+                    self.byte_count_table   += shard_bytes_table
+                    self.packet_count_persistent -= shard_pkts_existing
+                    self.byte_count_persistent -= shard_bytes_existing
+                    self.packet_count_persistent_existing += shard_pkts_existing
+                    self.byte_count_persistent_existing += shard_bytes_existing
+                    for me in cleared_entries:
+                        if me in self.match_entries:
+                            self.clear_existing_rule_flag(me)
+                    self.outstanding_switches.discard(switch)
+                    self.log.debug("Current set of outstanding switches is:")
+                    self.log.debug(str(self.outstanding_switches))
         # If have all necessary data, call user-land registered callbacks
-        self.log.info( ('*** Bucket %s flow_stats_reply\n' % self.bname) +
-                        ('table pktcount %d persistent pktcount %d total %d' % (
-                    self.packet_count_table,
-                    self.packet_count_persistent,
-                    self.packet_count_table + self.packet_count_persistent ) ) )
+        if self.log.isEnabledFor(logging.INFO):
+            self.log.info( ('*** Bucket %s flow_stats_reply\n' % self.bname) +
+                            ('table pktcount %d persistent pktcount %d total %d' % (
+                        self.packet_count_table,
+                        self.packet_count_persistent,
+                        self.packet_count_table + self.packet_count_persistent ) ) )
         if not self.outstanding_switches:
             self.log.debug("No outstanding switches; calling callbacks")
-            self.log.debug("*** Returning bucket %s counts.\n%s%s%s%s%s%s" % (
-                    self.bname,
-                    "table counts: %d\n" % self.packet_count_table,
-                    "perst. apply: %d\n" % self.packet_count_persistent_apply,
-                    "perst. remov: %d\n" % self.packet_count_persistent_removed,
-                    "perst. exist: %d\n" % self.packet_count_persistent_existing,
-                    "perst. total: %d\n" % self.packet_count_persistent,
-                    "bucket total: %d\n" % (self.packet_count_table +
-                                            self.packet_count_persistent)))
-            self.call_callbacks([(self.packet_count_table +
+            if self.log.isEnabledFor(logging.DEBUG):
+                self.log.debug("*** Returning bucket %s counts.\n%s%s%s%s%s%s" % (
+                        self.bname,
+                        "table counts: %d\n" % self.packet_count_table,
+                        "perst. apply: %d\n" % self.packet_count_persistent_apply,
+                        "perst. remov: %d\n" % self.packet_count_persistent_removed,
+                        "perst. exist: %d\n" % self.packet_count_persistent_existing,
+                        "perst. total: %d\n" % self.packet_count_persistent,
+                        "bucket total: %d\n" % (self.packet_count_table +
+                                                self.packet_count_persistent)))
+            self.call_callbacks(((self.packet_count_table +
                                   self.packet_count_persistent),
                                  (self.byte_count_table   +
-                                  self.byte_count_persistent)])
+                                  self.byte_count_persistent)))
             self.clear_transient_counters()
 
     def clear_existing_rule_flag(self, entry):
-        """Clear the "existing rule" flag for the provided entry in
-        self.matches. This method should only be called in the context of
-        holding the bucket's in_update_cv since it updates the matches
-        structure.
+        """Clear the "existing rule" flag for the provided entry. This method
+        should only be called in the context of holding the bucket's
+        in_update_cv since it updates the matches structure.
         """
-        assert k in self.matches
-        self.matches[k].existing_rule = False
+        assert entry in self.match_entries
+        self.matches_existing.discard(entry)
+
+    def get_matches(self):
+        """ Return matches contained in bucket as a string """
+        output = ""
+        with self.in_update_cv:
+            while self.in_update:
+                self.in_update_cv.wait()
+            for m in self.match_entries:
+                output += str(m) + '\n'
+        return output
 
     def __eq__(self, other):
         # TODO: if buckets eventually have names, equality should
         # be on names.
         return id(self) == id(other)
 
-    def add_match(self, match, priority, version):
+    def add_match(self, match, priority, version, existing_rule=False):
         """Add a match to list of classifier rules to be queried for counts,
         corresponding to a given version of the classifier.
         """
         k = self.rule_entry(match, priority, version)
-        if not k in self.matches:
-            self.matches[k] = self.match_status()
+        if not k in self.match_entries:
+            self.match_entries.add(k)
+            if existing_rule:
+                self.matches_existing.add(k)
 
     def delete_match(self, match, priority, version, to_be_deleted=False):
         """If a rule is deleted from the classifier, mark this rule (until we
         get the flow_removed message with the counters on it).
         """
         k = self.rule_entry(match, priority, version)
-        if k in self.matches:
+        if k in self.match_entries:
             if to_be_deleted:
-                del self.matches[k]
+                self.match_entries.discard(k)
+                self.matches_to_be_deleted.discard(k)
+                self.matches_existing.discard(k)
             else:
-                self.matches[k].to_be_deleted = True
+                self.matches_to_be_deleted.add(k)
 
 ################################################################################
 # Combinator Policies                                                          #
 ################################################################################
 
+class _PolicyRope(object):
+    """
+    Lazy concatenation of two policy sequences (lists or ropes).
+    Combinator operators like parallel.__add__ and sequential.__rshift__
+    build one of these in O(1) instead of copying both child lists;
+    CombinatorPolicy flattens the rope into a plain list only when the
+    policies are first iterated (eval specialization or compile).
+    """
+    __slots__ = ["left", "right", "_len"]
+
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+        self._len = len(left) + len(right)
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        stack = [self.right, self.left]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, _PolicyRope):
+                stack.append(node.right)
+                stack.append(node.left)
+            else:
+                for p in node:
+                    yield p
+
+
 class CombinatorPolicy(Policy):
     """
     Abstract class for policy combinators.
@@ -1347,29 +1779,60 @@ class CombinatorPolicy(Policy):
     :param policies: the policies to be combined.
     :type policies: list Policy
     """
+    _hash = None
+
     ### init : List Policy -> unit
     def __init__(self, policies=[]):
-        self.policies = list(policies)
+        if isinstance(policies, _PolicyRope):
+            self._policies = policies
+        else:
+            self._policies = list(policies)
         self._classifier = None
         super(CombinatorPolicy,self).__init__()
 
+    @property
+    def policies(self):
+        # Flatten a rope into a plain list on first access and cache it;
+        # all list consumers (indexing, slicing, equality) then see the
+        # usual list semantics.
+        if isinstance(self._policies, _PolicyRope):
+            self._policies = list(self._policies)
+        return self._policies
+
     def compile(self):
         """
         Produce a Classifier for this policy
 
         :rtype: Classifier
         """
-        if NO_CACHE: 
+        if NO_CACHE:
             self._classifier = self.generate_classifier()
         if not self._classifier:
-            self._classifier = self.generate_classifier()
+            self._classifier = _lookup_shared_classifier(self)
         return self._classifier
 
+    def _structural_key(self):
+        return (self.__class__,
+                tuple(p._structural_key() for p in self.policies))
+
     def __repr__(self):
         return "%s:\n%s" % (self.name(),util.repr_plus(self.policies))
 
+    def __hash__(self):
+        # Memoized structural hash over the child hashes; replaces the
+        # repr-based Filter hash, which stringified the whole subtree on
+        # every call.
+        h = self._hash
+        if h is None:
+            h = self._hash = hash((self.__class__.__name__,
+                                   tuple(hash(p) for p in self.policies)))
+        return h
+
     def __eq__(self, other):
+        if self is other:
+            return True
         return ( self.__class__ == other.__class__
+           and   hash(self) == hash(other)
            and   self.policies == other.policies )
 
 
@@ -1393,9 +1856,20 @@ class negate(CombinatorPolicy,Filter):
         else:
             return {pkt}
 
+    def eval_batch(self, pkts):
+        """
+        evaluate this policy on a collection of packets: the packets the
+        inner filter does not pass.
+
+        :param pkts: the packets on which to be evaluated
+        :type pkts: iterable Packet
+        :rtype: set Packet
+        """
+        pkts = set(pkts)
+        return pkts - self.policies[0].eval_batch(pkts)
+
     def generate_classifier(self):
-        inner_classifier = self.policies[0].compile()
-        return ~inner_classifier
+        return self.policies[0].compile().invert_actions()
 
 
 class parallel(CombinatorPolicy):
@@ -1418,12 +1892,16 @@ class parallel(CombinatorPolicy):
         if len(policies) == 0:
             raise TypeError
         super(parallel, self).__init__(policies)
+        # The policy list is fixed at construction; the child eval
+        # methods are bound once, on first eval, so that rope-built
+        # instances stay O(1) until actually evaluated.
+        self._policy_evals = None
 
     def __add__(self, pol):
         if isinstance(pol,parallel):
-            return parallel(self.policies + pol.policies)
+            return parallel(_PolicyRope(self._policies, pol._policies))
         else:
-            return parallel(self.policies + [pol])
+            return parallel(_PolicyRope(self._policies, [pol]))
 
     def eval(self, pkt):
         """
@@ -1434,16 +1912,42 @@ class parallel(CombinatorPolicy):
         :type pkt: Packet
         :rtype: set Packet
         """
-        output = set()
+        evs = self._policy_evals
+        if evs is None:
+            evs = self._policy_evals = tuple(p.eval for p in self.policies)
+        # Accumulate into a pooled scratch list and dedup once at the
+        # boundary, rather than paying Packet hash/eq costs on every
+        # inner |= step or allocating a fresh accumulator per packet.
+        output = _pkt_buf_pool.acquire()
+        try:
+            extend = output.extend
+            for ev in evs:
+                extend(ev(pkt))
+            return set(output)
+        finally:
+            _pkt_buf_pool.release(output)
+
+    def eval_batch(self, pkts):
+        """
+        evaluate this policy on a collection of packets: the union of
+        each child policy's batch evaluation over the whole collection.
+
+        :param pkts: the packets on which to be evaluated
+        :type pkts: iterable Packet
+        :rtype: set Packet
+        """
+        pkts = list(pkts)  # children each consume the whole collection
+        output = []
+        extend = output.extend
         for policy in self.policies:
-            output |= policy.eval(pkt)
-        return output
+            extend(policy.eval_batch(pkts))
+        return set(output)
 
     def generate_classifier(self):
         if len(self.policies) == 0:  # EMPTY PARALLEL IS A DROP
             return drop.compile()
-        classifiers = map(lambda p: p.compile(), self.policies)
-        return reduce(lambda acc, c: acc + c, classifiers)
+        classifiers = [p.compile() for p in self.policies]
+        return reduce(operator.add, classifiers)
 
 
 class union(parallel,Filter):
@@ -1470,9 +1974,9 @@ class union(parallel,Filter):
     ### or : Filter -> Filter
     def __or__(self, pol):
         if isinstance(pol,union):
-            return union(self.policies + pol.policies)
+            return union(_PolicyRope(self._policies, pol._policies))
         elif isinstance(pol,Filter):
-            return union(self.policies + [pol])
+            return union(_PolicyRope(self._policies, [pol]))
         else:
             raise TypeError
 
@@ -1497,12 +2001,34 @@ class sequential(CombinatorPolicy):
         if len(policies) == 0:
             raise TypeError
         super(sequential, self).__init__(policies)
+        # Stage structure is fixed at construction; the identity/drop
+        # checks are resolved once, on first eval, rather than on every
+        # call (and lazily, so rope-built instances stay O(1) until
+        # actually evaluated).
+        self._stages = None
+        self._stage_evals = None
+
+    def _build_stages(self):
+        # identity stages never contribute; a drop stage terminates the
+        # pipeline (marked None below) but stages before it still run,
+        # since they may have side effects (e.g. query buckets).
+        stages = []
+        for p in self.policies:
+            if p == identity:
+                continue
+            if p == drop:
+                stages.append(None)
+                break
+            stages.append(p)
+        self._stages = tuple(stages)
+        self._stage_evals = tuple(p.eval if p is not None else None
+                                  for p in stages)
 
     def __rshift__(self, pol):
         if isinstance(pol,sequential):
-            return sequential(self.policies + pol.policies)
+            return sequential(_PolicyRope(self._policies, pol._policies))
         else:
-            return sequential(self.policies + [pol])
+            return sequential(_PolicyRope(self._policies, [pol]))
 
     def eval(self, pkt):
         """
@@ -1515,27 +2041,57 @@ class sequential(CombinatorPolicy):
         :type pkt: Packet
         :rtype: set Packet
         """
-        prev_output = {pkt}
-        output = prev_output
-        for policy in self.policies:
+        if self._stage_evals is None:
+            self._build_stages()
+        # Ping-pong between two pooled scratch lists; dedup happens only
+        # once in the final set() rather than per intermediate stage.
+        pool = _pkt_buf_pool
+        prev_output = pool.acquire()
+        output = pool.acquire()
+        try:
+            prev_output.append(pkt)
+            for ev in self._stage_evals:
+                if not prev_output:
+                    return set()
+                if ev is None:  # drop stage
+                    return set()
+                del output[:]
+                extend = output.extend
+                for p in prev_output:
+                    extend(ev(p))
+                prev_output, output = output, prev_output
+            return set(prev_output)
+        finally:
+            pool.release(prev_output)
+            pool.release(output)
+
+    def eval_batch(self, pkts):
+        """
+        evaluate this policy on a collection of packets, threading the
+        whole surviving collection through each stage so stages with
+        batch-aware eval (e.g. match) run field-major over the batch.
+
+        :param pkts: the packets on which to be evaluated
+        :type pkts: iterable Packet
+        :rtype: set Packet
+        """
+        if self._stages is None:
+            self._build_stages()
+        prev_output = list(pkts)
+        for stage in self._stages:
             if not prev_output:
                 return set()
-            if policy == identity:
-                continue
-            if policy == drop:
+            if stage is None:  # drop stage
                 return set()
-            output = set()
-            for p in prev_output:
-                output |= policy.eval(p)
-            prev_output = output
-        return output
+            prev_output = stage.eval_batch(prev_output)
+        return set(prev_output)
 
     def generate_classifier(self):
         assert(len(self.policies) > 0)
-        classifiers = map(lambda p: p.compile(),self.policies)
+        classifiers = [p.compile() for p in self.policies]
         for c in classifiers:
             assert(c is not None)
-        return reduce(lambda acc, c: acc >> c, classifiers)
+        return reduce(operator.rshift, classifiers)
         
 
 class intersection(sequential,Filter):
@@ -1562,9 +2118,9 @@ class intersection(sequential,Filter):
     ### and : Filter -> Filter
     def __and__(self, pol):
         if isinstance(pol,intersection):
-            return intersection(self.policies + pol.policies)
+            return intersection(_PolicyRope(self._policies, pol._policies))
         elif isinstance(pol,Filter):
-            return intersection(self.policies + [pol])
+            return intersection(_PolicyRope(self._policies, [pol]))
         else:
             raise TypeError
 
@@ -1579,6 +2135,8 @@ class DerivedPolicy(Policy):
     :param policy: the internal policy (assigned to self.policy)
     :type policy: Policy
     """
+    _hash = None
+
     def __init__(self, policy=identity):
         self.policy = policy
         self._classifier = None
@@ -1594,16 +2152,26 @@ class DerivedPolicy(Policy):
         """
         return self.policy.eval(pkt)
 
+    def eval_batch(self, pkts):
+        """
+        evaluates to the batch output of self.policy.
+
+        :param pkts: the packets on which to be evaluated
+        :type pkts: iterable Packet
+        :rtype: set Packet
+        """
+        return self.policy.eval_batch(pkts)
+
     def compile(self):
         """
         Produce a Classifier for this policy
 
         :rtype: Classifier
         """
-        if NO_CACHE: 
+        if NO_CACHE:
             self._classifier = self.generate_classifier()
         if not self._classifier:
-            self._classifier = self.generate_classifier()
+            self._classifier = _lookup_shared_classifier(self)
         return self._classifier
 
     def netkat_compile(self, *args, **kwargs):
@@ -1613,11 +2181,24 @@ class DerivedPolicy(Policy):
     def generate_classifier(self):
         return self.policy.compile()
 
+    def _structural_key(self):
+        return (self.__class__, self.policy._structural_key())
+
     def __repr__(self):
         return "[DerivedPolicy]\n%s" % repr(self.policy)
 
+    def __hash__(self):
+        h = self._hash
+        if h is None:
+            h = self._hash = hash((self.__class__.__name__,
+                                   hash(self.policy)))
+        return h
+
     def __eq__(self, other):
+        if self is other:
+            return True
         return ( self.__class__ == other.__class__
+           and   hash(self) == hash(other)
            and ( self.policy == other.policy ) )
 
 
@@ -1654,8 +2235,21 @@ class if_(DerivedPolicy):
         self.pred = pred
         self.t_branch = t_branch
         self.f_branch = f_branch
-        super(if_,self).__init__((self.pred >> self.t_branch) +
-                                 ((~self.pred) >> self.f_branch))
+        # The (pred >> t) + (~pred >> f) expansion is only needed for
+        # compilation; eval below works straight off the branches. Defer
+        # building it (two sequentials, a parallel and a negate per if_)
+        # until first access, which deeply nested if_ chains may never
+        # trigger.
+        self._expansion = None
+        self._classifier = None
+        super(DerivedPolicy,self).__init__()
+
+    @property
+    def policy(self):
+        if self._expansion is None:
+            self._expansion = ((self.pred >> self.t_branch) +
+                               ((~self.pred) >> self.f_branch))
+        return self._expansion
 
     def eval(self, pkt):
         if self.pred.eval(pkt):
@@ -1678,7 +2272,12 @@ class fwd(DerivedPolicy):
     """
     def __init__(self, outport):
         self.outport = outport
-        super(fwd,self).__init__(modify(port=self.outport))
+        # fwd(p) built in different contexts shares the inner modify, so
+        # equal forwarding policies also share its cached classifier.
+        m = _port_modify_intern.get(outport)
+        if m is None:
+            m = _port_modify_intern[outport] = modify(port=outport)
+        super(fwd,self).__init__(m)
 
     def __repr__(self):
         return "fwd %s" % self.outport
@@ -1694,12 +2293,42 @@ class xfwd(DerivedPolicy):
     """
     def __init__(self, outport):
         self.outport = outport
-        super(xfwd,self).__init__((~match(port=outport)) >> fwd(outport))
+        # The inner composition depends only on the port; share it
+        # across xfwd instances for the same reason as in fwd.
+        inner = _xfwd_inner_intern.get(outport)
+        if inner is None:
+            inner = _xfwd_inner_intern[outport] = (
+                (~_interned_match(port=outport)) >> _interned_fwd(outport))
+        super(xfwd,self).__init__(inner)
 
     def __repr__(self):
         return "xfwd %s" % self.outport
 
 
+# Flyweight tables for port-keyed forwarding policies. Topology-driven
+# policies (flood in particular) rebuild fwd/xfwd per port on every
+# network event; interning keeps one instance per port so rebuilt trees
+# hit the classifier cache instead of recompiling.
+_port_modify_intern = {}
+_xfwd_inner_intern = {}
+_fwd_intern = {}
+_xfwd_intern = {}
+
+def _interned_fwd(outport):
+    """ Flyweight constructor for fwd. """
+    f = _fwd_intern.get(outport)
+    if f is None:
+        f = _fwd_intern[outport] = fwd(outport)
+    return f
+
+def _interned_xfwd(outport):
+    """ Flyweight constructor for xfwd. """
+    f = _xfwd_intern.get(outport)
+    if f is None:
+        f = _xfwd_intern[outport] = xfwd(outport)
+    return f
+
+
 ################################################################################
 # Dynamic Policies                                                             #
 ################################################################################
@@ -1714,6 +2343,13 @@ class DynamicPolicy(DerivedPolicy):
         self._policy = policy
         self.notify = None
         self._classifier = None
+        # Bumped on every policy reassignment so stale classifiers for
+        # trees containing this node miss the shared classifier cache.
+        self._policy_epoch = 0
+        # Serializes policy reassignment against concurrent readers:
+        # handlers may swap the policy from application threads while
+        # the runtime compiles or evaluates it.
+        self._policy_lock = threading.RLock()
         super(DerivedPolicy,self).__init__()
 
     def set_network(self, network):
@@ -1735,10 +2371,32 @@ class DynamicPolicy(DerivedPolicy):
 
     @policy.setter
     def policy(self, policy):
-        prev_policy = self._policy
-        self._policy = policy
+        # Publish the new policy, epoch and cleared classifier together
+        # under the lock, so readers never observe the old classifier
+        # against the new policy; notification runs outside the lock to
+        # avoid holding it across arbitrary user callbacks.
+        with self._policy_lock:
+            self._policy = policy
+            self._policy_epoch += 1
+            self._classifier = None
         self.changed()
 
+    def _structural_key(self):
+        # Identity plus epoch: the wrapped policy can be swapped at any
+        # time, so structurally-keyed sharing is unsafe across instances.
+        return (self, self._policy_epoch)
+
+    def __hash__(self):
+        # The wrapped policy is mutable, so the memoized structural hash
+        # from DerivedPolicy would go stale; hash on identity instead.
+        return id(self)
+
+    def __eq__(self, other):
+        # No hash short-circuit here: equal dynamic policies can have
+        # distinct identity hashes.
+        return ( self.__class__ == other.__class__
+           and ( self.policy == other.policy ) )
+
     def __repr__(self):
         return "[DynamicPolicy]\n%s" % repr(self.policy)
 
@@ -1775,26 +2433,50 @@ class flood(DynamicPolicy):
     """
     def __init__(self):
         self.mst = None
+        # Signature of the topology inputs the MST depends on; identical
+        # signatures short-circuit both the MST recompute and the
+        # isomorphism-based graph comparison it used to feed.
+        self._topo_signature = None
+        # Memoized per-switch flood subtrees keyed on (switch, ports),
+        # so unchanged switches reuse their sub-policy (and its cached
+        # classifier) across rebuilds.
+        self._switch_pols = {}
         self.log = logging.getLogger('%s.flood' % __name__)
         super(flood,self).__init__()
 
+    def _topology_signature(self, topology):
+        return (frozenset((switch, frozenset(ports))
+                          for switch, ports
+                          in topology.switch_with_port_ids_list()),
+                frozenset(frozenset(edge) for edge in topology.edges()))
+
+    def _switch_flood_policy(self, switch, ports):
+        key = (switch, frozenset(ports))
+        pol = self._switch_pols.get(key)
+        if pol is None:
+            pol = self._switch_pols[key] = (
+                _interned_match(switch=switch) >>
+                parallel(map(_interned_xfwd,ports)))
+        return pol
+
     def set_network(self, network):
         changed = False
         if not network is None:
-            updated_mst = Topology.minimum_spanning_tree(network.topology)
-            if not self.mst is None:
-                if self.mst != updated_mst:
-                    self.mst = updated_mst
-                    changed = True
-            else:
-                self.mst = updated_mst
+            # The MST is a deterministic function of the switches, their
+            # port sets, and the links; if none of those changed since
+            # the last update there is nothing to recompute. Comparing
+            # these frozensets replaces the exact-isomorphism Topology
+            # comparison, which walked both graphs on every update.
+            updated_signature = self._topology_signature(network.topology)
+            if updated_signature != self._topo_signature:
+                self._topo_signature = updated_signature
+                self.mst = Topology.minimum_spanning_tree(network.topology)
                 changed = True
         if changed:
-            self.log.debug("Printing updated MST:\n %s" % str(updated_mst))
+            self.log.debug("Printing updated MST:\n %s", self.mst)
             self.policy = parallel([
-                match(switch=switch) >>
-                parallel(map(xfwd,ports))
-                for switch,ports 
+                self._switch_flood_policy(switch,ports)
+                for switch,ports
                 in self.mst.switch_with_port_ids_list()])
                 
     def __repr__(self):
@@ -1811,14 +2493,22 @@ class edge_network(DynamicFilter):
     """
     def __init__(self):
         self.egresses = None
+        self._egresses_frozen = None
         super(edge_network,self).__init__()
 
     def set_network(self, network):
         updated_egresses = network.topology.egress_locations()
-        if not self.egresses == updated_egresses:
+        # Compare as a frozenset: a topology event that returns the same
+        # locations in a different order is not a change, and skipping
+        # the rebuild avoids the recompile cascade a policy reassignment
+        # triggers in every downstream listener. The list form is kept
+        # for deterministic policy iteration.
+        updated_frozen = frozenset(updated_egresses)
+        if self._egresses_frozen != updated_frozen:
+            self._egresses_frozen = updated_frozen
             self.egresses = updated_egresses
-            self.policy = union([match(switch=l.switch,
-                                       port=l.port_no)
+            self.policy = union([_interned_match(switch=l.switch,
+                                                 port=l.port_no)
                                  for l in self.egresses])
 
 
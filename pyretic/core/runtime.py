@@ -1801,7 +1801,7 @@ class Runtime(object):
         Returns a function that can be used by counting buckets to
         issue queries from the runtime."""
         def pull_bucket_stats():
-            preds = [me.match for me in bucket.matches.keys()]
+            preds = [me.match for me in bucket.match_entries]
             return self.pull_switches_for_preds(preds, bucket)
         return pull_bucket_stats
 
@@ -1810,7 +1810,7 @@ class Runtime(object):
         at least one rule that was already created in an earlier classifier.
         """
         def pull_existing_bucket_stats():
-            preds = [me.match for me,ms in bucket.matches.items() if ms.existing_rule]
+            preds = [me.match for me in bucket.matches_existing]
             return self.pull_switches_for_preds(preds, bucket)
         return pull_existing_bucket_stats
 
@@ -2493,6 +2493,9 @@ class abstract_virtual_field(object):
     stages = {}
     stage_offset_nbits = {}
     virtual_none = DynamicPolicy(identity)
+    # Bumped whenever the set of registered fields changes, so that
+    # caches of virtual-field translations can detect staleness.
+    registry_version = 0
 
     def __init__(self, name, values, type="string", stage=0):
         self.name   = name
@@ -2509,6 +2512,7 @@ class abstract_virtual_field(object):
             cls.stages[stage] = [self]
         cls.allocate_stage_bits()
         cls.reset_virtual_none()
+        abstract_virtual_field.registry_version += 1
 
     @classmethod
     def clear(cls):
@@ -2518,6 +2522,7 @@ class abstract_virtual_field(object):
         cls.stages = {}
         cls.stage_offset_nbits = {}
         cls.virtual_none.policy = identity
+        abstract_virtual_field.registry_version += 1
 
     @classmethod
     def get_class(cls, name):
@@ -31,6 +31,7 @@
 # Utility functions                                                            #
 ################################################################################
 
+from collections import OrderedDict
 from functools import wraps
 
 from multiprocessing import Lock
@@ -178,6 +179,7 @@ class QueueStreamHandler(StreamHandler):
         '''Acquire the lock before emitting the record.'''
         self.queue.put(record)
 
+@cached
 def string_to_network(ip_str):
     """ Return an IPv4Network object from a dotted quad IP address/subnet. """
     try:
@@ -185,11 +187,24 @@ def string_to_network(ip_str):
     except AddressValueError:
         raise TypeError('Input not a valid IP address!')
 
+""" string_to_IP is called on live packet header values, so its memo must be
+bounded: evict in FIFO order once the cache exceeds _IP_CACHE_MAX entries. """
+_IP_CACHE_MAX = 4096
+_ip_cache = OrderedDict()
+
 def string_to_IP(ip_str):
     try:
-        return IPv4Address(ip_str)
+        return _ip_cache[ip_str]
+    except KeyError:
+        pass
+    try:
+        ip = IPv4Address(ip_str)
     except AddressValueError:
         raise TypeError('Input not a valid IP address!')
+    _ip_cache[ip_str] = ip
+    if len(_ip_cache) > _IP_CACHE_MAX:
+        _ip_cache.popitem(last=False)
+    return ip
 
 def network_to_string(ip_net):
     """ Return a dotted quad IP address/subnet from an IPv4Network object. """
@@ -43,11 +43,13 @@ import pydot
 import copy
 
 from pyretic.core.language import Controller, fwd, CombinatorPolicy
-from pyretic.core.language import negate, union, intersection
+from pyretic.core.language import negate, union, intersection, parallel
 from pyretic.core import util
 import pickle
 from pyretic.evaluations.stat import Stat
 from netaddr import IPNetwork, cidr_merge
+import os
+import tempfile
 import time
 import logging
 import sys
@@ -55,12 +57,14 @@ from collections import Counter
 
 TOKEN_START_VALUE = 0 # start with printable ASCII for visual inspection ;)
 TOKEN_END_VALUE = 0xFFFFFFFF 
-# token type definitions
-TOK_INGRESS = "ingress"
-TOK_EGRESS = "egress"
-TOK_DROP = "drop"
-TOK_END_PATH = "end_path"
-TOK_HOOK = "ingress_hook"
+# token type definitions: small integer codes (cheaper to hash and compare
+# than strings); TOK_NAMES maps them back for debugging output
+TOK_INGRESS = 0
+TOK_EGRESS = 1
+TOK_DROP = 2
+TOK_END_PATH = 3
+TOK_HOOK = 4
+TOK_NAMES = ("ingress", "egress", "drop", "end_path", "ingress_hook")
 # limit on the number of stages for multi-stage table rule packing
 MAX_STAGES = 13
 # Runtime write log, for a single place to log everything from the runtime
@@ -86,11 +90,15 @@ class classifier_utils(object):
     """ Utilities related to analysis of classifiers, that come in handy to do
     various manipulations on policies.
     """
+    intersect_cache = {}
+    INTERSECT_CACHE_MAX = 16384
+
     @classmethod
     def __set_init_vars__(cls, match_enabled):
         cls.match_enabled = match_enabled
         cls.intersect_called = 0
-        cls.overlap_called = 0 
+        cls.overlap_called = 0
+        cls.intersect_cache = {}
     @classmethod
     def __get_classifier__(cls, p):
         # Hackety hack
@@ -128,9 +136,57 @@ class classifier_utils(object):
         :type p1: Policy
         :param p2: Policy
         :type p2: Policy
+
+        Results are memoized on the identities of the operand policies, since
+        the same (predicate, predicate) pairs recur for every atom that refers
+        to a leaf-level predicate. Intersection is symmetric, so a result
+        recorded for (p1, p2) also answers (p2, p1). Entries keep strong
+        references to their operands, so a cache hit is only possible while
+        both operands are alive (no stale hits from id reuse).
         """
-        return cls.is_not_drop(p1 & p2) 
-           
+        key = (id(p1), id(p2))
+        cached = cls.intersect_cache.get(key)
+        if cached is not None and cached[0] is p1 and cached[1] is p2:
+            return cached[2]
+        cached = cls.intersect_cache.get((id(p2), id(p1)))
+        if cached is not None and cached[0] is p2 and cached[1] is p1:
+            return cached[2]
+        res = cls.__quick_intersection__(p1, p2)
+        if res is None:
+            res = cls.is_not_drop(p1 & p2)
+        if len(cls.intersect_cache) >= cls.INTERSECT_CACHE_MAX:
+            cls.intersect_cache.clear()
+        cls.intersect_cache[key] = (p1, p2, res)
+        return res
+
+    @classmethod
+    def __quick_intersection__(cls, p1, p2):
+        """ Cheap checks that can decide an intersection without compiling the
+        product classifier. Returns True or False when a decision is possible,
+        None to fall through to the classifier-based check. """
+        if p1 is drop or p2 is drop:
+            return False
+        if p1 is identity:
+            return cls.is_not_drop(p2)
+        if p2 is identity:
+            return cls.is_not_drop(p1)
+        if type(p1) == match and type(p2) == match:
+            for (f, v) in p1.map.iteritems():
+                if f in ('srcip', 'dstip'):
+                    """ IP matches may overlap as prefixes even when their
+                    values differ; leave those to the classifier. """
+                    continue
+                if f in p2.map and p2.map[f] != v:
+                    return False
+        return None
+
+    @classmethod
+    def clear_intersect_cache(cls):
+        """ Drop all memoized intersection results, releasing references to the
+        predicates they mention. """
+        cls.intersect_cache.clear()
+
+
     @classmethod
     def get_overlap_mode(cls, pred, pred_neg, new_pred, new_pred_neg):
         """ Returns a tuple (is_equal, is_superset, is_subset, intersects) of
@@ -499,6 +555,7 @@ class fdd_re_tree_gen(object):
         self.leaf_list = []
         self.base = None
         self.dyn_preds = []
+        self._unaffected_pred = None
 
     def clear(self):
         self.num_to_pred = {}
@@ -512,6 +569,7 @@ class fdd_re_tree_gen(object):
         self.leaf_list = []
         self.base = None
         self.dyn_preds = []
+        self._unaffected_pred = None
 
     @classmethod
     def global_sym_list(cls):
@@ -574,6 +632,7 @@ class fdd_re_tree_gen(object):
             self.base = FDDTranslator.merge(pred_fdd, self.base, {}, True)
 
     def prep_re_tree(self):
+        self._unaffected_pred = None
         FDDTranslator.assign_path(self.base, ({}, set()), self.neg_cache)
         self.leaf_list = self.base.get_leaves()
         for leaf in self.leaf_list:
@@ -595,11 +654,9 @@ class fdd_re_tree_gen(object):
          
         if not pred in self.pred_to_leafs:
             return re_empty()
-        
-        re_tree = re_empty()
-        for leaf in self.pred_to_leafs[pred]:
-            re_tree |= re_symbol(leaf.symbol, metadata=at)
-        return re_tree
+
+        return smart_alter_list([re_symbol(leaf.symbol, metadata=at)
+                                 for leaf in self.pred_to_leafs[pred]])
  
     def get_re_string(self, pred, at):
         assert isinstance(at, abstract_atom)
@@ -612,31 +669,35 @@ class fdd_re_tree_gen(object):
         return '(' + string.join(syms, ')|(') + ')'
 
     def get_leaf_preds(self):
-        output = ''
-        for sym in self.symbol_to_pred:
-            pred = self.symbol_to_pred[sym]
-            output += (str(sym) + ': ' + repr(pred) + '\n')
-        return output
+        return ''.join(str(sym) + ': ' + repr(pred) + '\n'
+                       for (sym, pred) in self.symbol_to_pred.iteritems())
+
 
-    
     def get_unaffected_pred(self):
-        """ Predicate that covers packets unaffected by query predicates. """
+        """ Predicate that covers packets unaffected by query predicates.
+        Memoized until the leaf predicates are next rebuilt. """
+        if self._unaffected_pred is not None:
+            return self._unaffected_pred
         pred_list = self.symbol_to_pred.values()
-        if len(pred_list) >= 1:
-            return ~(reduce(lambda a,x: a | x, pred_list))
+        if len(pred_list) > 1:
+            res = ~union(pred_list)
+        elif len(pred_list) == 1:
+            res = ~pred_list[0]
         else:
-            return identity
+            res = identity
+        self._unaffected_pred = res
+        return res
 
     def __new_token__(self):
         re_tree_gen.token += 2
         if re_tree_gen.token > TOKEN_END_VALUE:
-            re_tree_gen.token = re_tree_gen.token_start
+            re_tree_gen.token = TOKEN_START_VALUE
 
     def __new_symbol__(self):
         """ Returns a new token/symbol for a leaf-level predicate. """
         self.__new_token__()
-        sym_list = re_tree_gen.global_sym_list()
-        while re_tree_gen.token in sym_list:
+        sym_set = re_tree_gen.global_sym_set
+        while re_tree_gen.token in sym_set:
             self.__new_token__()
 
         return re_tree_gen.token
@@ -663,8 +724,12 @@ class re_tree_gen(object):
     token = TOKEN_START_VALUE
     in_cg_list = []
     out_cg_list = []
+    """ Flat set mirroring the symbols allocated across all character
+    generators, maintained incrementally so fresh-symbol probes are O(1)
+    instead of rebuilding the global symbol list per probe. """
+    global_sym_set = set()
 
-    def __init__(self, switch_cnt = None, 
+    def __init__(self, switch_cnt = None,
                     cache_enabled = False, partition_enabled = False):
         if switch_cnt is None or not partition_enabled:
             self.simple = True
@@ -683,7 +748,9 @@ class re_tree_gen(object):
         self.pred_to_neg = {}
         self.dyn_preds      = []
         self.cache = {}
-    
+        self._unaffected_pred = None
+        self._pred_union = {}
+
     @classmethod
     def global_sym_list(cls):
         res = []
@@ -760,6 +827,17 @@ class re_tree_gen(object):
         sym_to_pred[symbol] = pred
         pred_to_atoms[pred] = atoms
         pred_to_neg[pred] = pred_neg
+        re_tree_gen.global_sym_set.add(symbol)
+        self._unaffected_pred = None
+        """ Extend the memoized union only if a valid entry exists. It must
+        never be (re)seeded here: after __del_pred__ invalidates it, this
+        method can run while pred_to_symbol still holds predicates that a
+        fresh union would not cover. get_re_tree_core rebuilds it lazily
+        from the full predicate set. """
+        part_key = None if self.simple else partition
+        cur_union = self._pred_union.get(part_key)
+        if cur_union is not None:
+            self._pred_union[part_key] = cur_union | pred
 
         if not self.simple:
             self.symbol_to_pred[symbol] = pred
@@ -792,6 +870,11 @@ class re_tree_gen(object):
         del sym_pred[symbol]
         del pred_atoms[pred]
         del pred_neg[pred]
+        re_tree_gen.global_sym_set.discard(symbol)
+        self._unaffected_pred = None
+        """ Deletions cannot be applied to the union incrementally; recompute
+        lazily on the next disjointness check. """
+        self._pred_union.pop(None if self.simple else partition, None)
 
         if not self.simple:
             del self.symbol_to_pred[symbol]
@@ -799,13 +882,13 @@ class re_tree_gen(object):
     def __new_token__(self):
         re_tree_gen.token += 2
         if re_tree_gen.token > TOKEN_END_VALUE:
-            re_tree_gen.token = re_tree_gen.token_start
+            re_tree_gen.token = TOKEN_START_VALUE
 
     def __new_symbol__(self):
         """ Returns a new token/symbol for a leaf-level predicate. """
         self.__new_token__()
-        sym_list = re_tree_gen.global_sym_list()
-        while re_tree_gen.token in sym_list:
+        sym_set = re_tree_gen.global_sym_set
+        while re_tree_gen.token in sym_set:
             self.__new_token__()
 
         return re_tree_gen.token
@@ -823,10 +906,8 @@ class re_tree_gen(object):
                 assert re_tree.metadata == []
                 return re_symbol(re_tree.char, metadata=m, lst=False)
             elif isinstance(re_tree, re_alter):
-                new_re = re_empty()
-                for re in re_tree.re_list:
-                    new_re = new_re | new_metadata_tree(m, re)
-                return new_re
+                return smart_alter_list([new_metadata_tree(m, re)
+                                         for re in re_tree.re_list])
             else:
                 raise TypeError("Trees are only allowed to have alternation!")
 
@@ -841,10 +922,8 @@ class re_tree_gen(object):
                 else:
                     return old_re_tree
             elif isinstance(old_re_tree, re_alter):
-                new_re = re_empty()
-                for re in old_re_tree.re_list:
-                    new_re = new_re | replace_node(re, new_re_tree, old_sym)
-                return new_re
+                return smart_alter_list([replace_node(re, new_re_tree, old_sym)
+                                         for re in old_re_tree.re_list])
             else:
                 raise TypeError("Trees are only allowed to have alternation!")
        
@@ -857,13 +936,12 @@ class re_tree_gen(object):
  
         assert old_pred in pred_sym and old_pred in pred_atoms
         old_sym = pred_sym[old_pred]
-        new_re_tree = re_empty()
         # Construct replacement tree (without metadata first)
         for pred in new_preds:
             assert pred in pred_sym
             assert pred in pred_atoms
-            new_sym = pred_sym[pred]
-            new_re_tree = new_re_tree | re_symbol(new_sym)
+        new_re_tree = smart_alter_list([re_symbol(pred_sym[pred])
+                                        for pred in new_preds])
         # For each atom containing old_pred, replace re leaf by new tree.
         for at in pred_atoms[old_pred]:
             new_atom_re_tree = replace_node(at.gen_re_tree(self), new_re_tree, old_sym)
@@ -897,10 +975,8 @@ class re_tree_gen(object):
                 update_dicts(sym, at)
                 return re_symbol(sym, metadata = at)
             elif isinstance(eq_re_tree, re_alter):
-                res = re_empty()
-                for sym in eq_re_tree.re_list:
-                    res |= create_re_tree(sym, at)
-                return res
+                return smart_alter_list([create_re_tree(sym, at)
+                                         for sym in eq_re_tree.re_list])
             else:
                 print type(eq_re_tree)
                 raise TypeError
@@ -962,6 +1038,25 @@ class re_tree_gen(object):
             explicitly to set up recompilation routines in the runtime."""
             self.__add_dyn_preds__(dyn_pols, at.policy)
         new_pred_neg = ~new_pred
+        new_pred_not_drop = is_not_drop(new_pred)
+
+        """ Fast path: stored predicates are mutually disjoint, so a new
+        predicate disjoint from their union cannot overlap any of them
+        individually. One intersection check against the (incrementally
+        maintained) union then replaces the per-predicate overlap analysis
+        below. """
+        if pred_list:
+            part_key = None if self.simple else partition
+            pred_union = self._pred_union.get(part_key)
+            if pred_union is None:
+                pred_union = (union(pred_list) if len(pred_list) > 1
+                              else pred_list[0])
+                self._pred_union[part_key] = pred_union
+            if not ne_inters(new_pred, pred_union):
+                if new_pred_not_drop:
+                    add_pred(new_pred, new_sym(), [at], new_pred_neg, partition)
+                    re_tree |= re_symbol(pred_to_symbol[new_pred], metadata=at)
+                return re_tree
 
         """ For each case of overlap between new and existing predicates, do
         actions that will only retain and keep track of non-overlapping
@@ -972,7 +1067,7 @@ class re_tree_gen(object):
             pred_symbol = pred_to_symbol[pred]
             pred_neg = pred_to_neg[pred]
             (is_equal,is_superset,is_subset,intersects, new_and_not_pred, not_new_and_pred) = ovlap(pred, pred_neg, new_pred, new_pred_neg)
-            if not is_not_drop(new_pred):
+            if not new_pred_not_drop:
                 """ i.e., new_pred empty """
                 re_tree |= re_empty()
                 return re_tree
@@ -992,7 +1087,7 @@ class re_tree_gen(object):
                 return re_tree
             elif is_subset:
                 new_pred = new_pred & pred_neg
-                #new_pred_not_drop = new_and_not_pred
+                new_pred_not_drop = new_and_not_pred
                 new_pred_neg = ~new_pred
                 pred_atoms.append(at)
                 re_tree |= re_symbol(pred_symbol, metadata=at)
@@ -1008,11 +1103,11 @@ class re_tree_gen(object):
                 added_sym = pred_to_symbol[inter_p]
                 re_tree |= re_symbol(added_sym, metadata=at)
                 new_pred = new_pred & pred_neg
-                #new_pred_not_drop = new_and_not_pred
+                new_pred_not_drop = new_and_not_pred
                 new_pred_neg = ~new_pred
             else:
                 pass
-        if is_not_drop(new_pred):
+        if new_pred_not_drop:
             """ The new predicate should be added if some part of it doesn't
             intersect any existing predicate, i.e., new_pred is not drop.
             """
@@ -1024,13 +1119,17 @@ class re_tree_gen(object):
 
     def clear(self):
         """ Completely reset character generating structures. """
+        classifier_utils.clear_intersect_cache()
+        re_tree_gen.global_sym_set.difference_update(self.symbol_to_pred)
         self.pred_to_atoms = {}
         self.pred_to_symbol = {}
         self.symbol_to_pred = {}
         self.pred_to_neg = {}
         self.dyn_preds = []
         self.cache = {}
-        
+        self._unaffected_pred = None
+        self._pred_union = {}
+
         if not self.simple:
             self.part_symbol_to_pred = {}
             for i in range(1, self.switch_cnt + 1):
@@ -1047,11 +1146,8 @@ class re_tree_gen(object):
     def get_leaf_preds(self):
         """ Get a string representation of all leaf-level predicates in the
         structure. """
-        output = ''
-        for sym in self.symbol_to_pred:
-            pred = self.symbol_to_pred[sym]
-            output += (str(sym) + ': ' + repr(pred) + '\n')
-        return output
+        return ''.join(str(sym) + ': ' + repr(pred) + '\n'
+                       for (sym, pred) in self.symbol_to_pred.iteritems())
 
 
     def get_dyn_preds(self):
@@ -1069,12 +1165,23 @@ class re_tree_gen(object):
         return res
 
     def get_unaffected_pred(self):
-        """ Predicate that covers packets unaffected by query predicates. """
+        """ Predicate that covers packets unaffected by query predicates.
+
+        The result is rebuilt from scratch by OR'ing every leaf-level
+        predicate, and is requested several times per compilation pass, so it
+        is memoized until the predicate set next changes.
+        """
+        if self._unaffected_pred is not None:
+            return self._unaffected_pred
         pred_list = self.get_predlist()
-        if len(pred_list) >= 1:
-            return ~(reduce(lambda a,x: a | x, pred_list))
+        if len(pred_list) > 1:
+            res = ~union(pred_list)
+        elif len(pred_list) == 1:
+            res = ~pred_list[0]
         else:
-            return identity
+            res = identity
+        self._unaffected_pred = res
+        return res
 
 """ Character generator classes belonging to "ingress" and "egress" matching
 predicates, respectively. """
@@ -1100,6 +1207,11 @@ class __out_re_tree_gen__(re_tree_gen):
 #############################################################################
 
 class path_policy(object):
+    """ Path policies and paths are instantiated in bulk when queries are
+    expanded (e.g., by groupby substitution), so the whole hierarchy declares
+    __slots__ to avoid a per-instance __dict__. """
+    __slots__ = ('path', 'piped_policy')
+
     def __init__(self, p, q):
         """ Defines a "path policy" object, which is a combination of a path
         function (trajectory -> {pkt}), and a policy function (pkt -> {pkt}),
@@ -1162,6 +1274,8 @@ class path_policy(object):
         return id(self)
 
 class path_policy_union(path_policy):
+    __slots__ = ('path_policies',)
+
     def __init__(self, ppols):
         """ Class that denotes a collection of path policies in an AST of '+'
         operators. """
@@ -1187,6 +1301,8 @@ class path_policy_union(path_policy):
 
 
 class dynamic_path_policy(path_policy):
+    __slots__ = ('_path_policy', 'path_notify')
+
     def __init__(self, path_pol):
         """ Dynamic path object. The self.path_policy object denotes the
         internal representation of the path policy at any given point, similar
@@ -1331,6 +1447,8 @@ class path_policy_utils(object):
 
 
 class path(path_policy):
+    __slots__ = ('measure_loc', 'grouping_fvlist', 're_tree')
+
     MEASURE_LOC_UPSTREAM = 1
     MEASURE_LOC_DOWNSTREAM = 2
 
@@ -1424,6 +1542,8 @@ class path(path_policy):
 
 class path_epsilon(path):
     """ Path of length 0. """
+    __slots__ = ()
+
     def __init__(self):
         self.re_tree = re_epsilon()
         super(path_epsilon, self).__init__()
@@ -1440,6 +1560,8 @@ class path_epsilon(path):
 
 class path_empty(path):
     """ Empty path object. """
+    __slots__ = ()
+
     def __init__(self):
         self.re_tree = re_empty()
         super(path_empty, self).__init__()
@@ -1466,6 +1588,8 @@ class abstract_atom(object):
     :param m: a Filter (or match) object used to initialize the path atom.
     :type match: Filter
     """
+    __slots__ = ('policy', '_re_tree', 'tree_counter', 're_tree_class')
+
     def __init__(self, m, re_tree_class=re_tree_gen):
         assert isinstance(m, Filter)
         self.policy = m
@@ -1518,17 +1642,24 @@ class abstract_atom(object):
 
 class __in__(abstract_atom):
     """ Atom type that only matches a predicate at the entry of a switch. """
+    __slots__ = ()
+
     def __init__(self, m):
         super(__in__, self).__init__(m, re_tree_class=__in_re_tree_gen__)
 
 class __out__(abstract_atom):
     """ Atom type that only matches a predicate at the exit of a switch. """
+    __slots__ = ()
+
     def __init__(self, m):
         super(__out__, self).__init__(m, re_tree_class=__out_re_tree_gen__)
 
 
 class in_out_atom(path):
     """ The leaf atom for all path queries. """
+    __slots__ = ('in_pred', 'out_pred', 'in_atom', 'out_atom', '_re_tree',
+                 'tree_counter')
+
     def __init__(self, in_pred, out_pred):
         self.in_pred  = in_pred
         self.out_pred = out_pred
@@ -1575,15 +1706,21 @@ class in_out_atom(path):
         self.tree_counter += 1
 
 class in_atom(in_out_atom):
+    __slots__ = ()
+
     def __init__(self, m):
         super(in_atom, self).__init__(m, identity)
 
 class out_atom(in_out_atom):
+    __slots__ = ()
+
     def __init__(self, m):
         super(out_atom, self).__init__(identity, m)
 
 class atom(in_atom):
     """A concrete "ingress" match atom."""
+    __slots__ = ()
+
     def __init__(self, m):
         super(atom, self).__init__(m)
 
@@ -1593,6 +1730,8 @@ class in_out_group(in_out_atom):
     by the values of the fields specified in the groupby=... argument of the
     constructor.
     """
+    __slots__ = ('in_groupby', 'out_groupby')
+
     def __init__(self, in_pred, out_pred, in_groupby=[], out_groupby=[]):
         self.in_groupby = sorted(in_groupby)
         self.out_groupby = sorted(out_groupby)
@@ -1625,10 +1764,14 @@ class in_out_group(in_out_atom):
                 'out_grouping:' + str(self.out_groupby) + '\n')
 
 class in_group(in_out_group):
+    __slots__ = ()
+
     def __init__(self, pred, groupby=[]):
         super(in_group, self).__init__(pred, identity, groupby, [])
 
 class out_group(in_out_group):
+    __slots__ = ()
+
     def __init__(self, pred, groupby=[]):
         super(out_group, self).__init__(identity, pred, [], groupby)
 
@@ -1636,6 +1779,8 @@ class out_group(in_out_group):
 
 class path_combinator(path):
     """ Base class for all path combinators. """
+    __slots__ = ('paths',)
+
     def __init__(self, paths=None):
         self.paths = paths
         super(path_combinator, self).__init__()
@@ -1662,6 +1807,8 @@ class path_combinator(path):
 
 class path_alternate(path_combinator):
     """ Alternation of paths. """
+    __slots__ = ()
+
     def __init__(self, paths_list):
         self.__check_type(paths_list)
         super(path_alternate, self).__init__(paths=paths_list)
@@ -1682,6 +1829,8 @@ class path_alternate(path_combinator):
 
 class path_star(path_combinator):
     """ Kleene star on a path. """
+    __slots__ = ()
+
     def __init__(self, p):
         self.__check_type(p)
         super(path_star, self).__init__(paths=(p if isinstance(p, list) else [p]))
@@ -1699,6 +1848,8 @@ class path_star(path_combinator):
 
 class path_concat(path_combinator):
     """ Concatenation of paths. """
+    __slots__ = ()
+
     def __init__(self, paths_list):
         self.__check_type(paths_list)
         super(path_concat, self).__init__(paths=paths_list)
@@ -1736,6 +1887,8 @@ class path_concat(path_combinator):
 
 class path_negate(path_combinator):
     """ Negation of paths. """
+    __slots__ = ()
+
     def __init__(self, p):
         self.__check_type(p)
         super(path_negate, self).__init__(paths=(p if isinstance(p, list) else [p]))
@@ -1753,6 +1906,8 @@ class path_negate(path_combinator):
 
 class path_inters(path_combinator):
     """ Intersection of paths. """
+    __slots__ = ()
+
     def __init__(self, paths_list):
         self.__check_type(paths_list)
         super(path_inters, self).__init__(paths=paths_list)
@@ -2880,8 +3035,34 @@ class pathcomp(object):
         in_capture = None
         out_capture = None
 
-        match_tag = cls.__num_match_tag__
-        set_tag   = cls.__num_set_tag__
+        ''' Memoize per-state tag policies: the edge loops below request the
+        same state's match/modify once per incident edge. '''
+        tag_match_cache = {}
+        tag_set_cache = {}
+        def match_tag(num, vfield):
+            key = (num, vfield)
+            try:
+                return tag_match_cache[key]
+            except KeyError:
+                tag_match_cache[key] = pol = cls.__num_match_tag__(num, vfield)
+                return pol
+        def set_tag(num, vfield):
+            key = (num, vfield)
+            try:
+                return tag_set_cache[key]
+            except KeyError:
+                tag_set_cache[key] = pol = cls.__num_set_tag__(num, vfield)
+                return pol
+
+        def build_parallel(parts, default=drop):
+            """ Compose fragments collected in a list with one parallel
+            build, instead of growing the composition one '+=' at a time. """
+            if not parts:
+                return default
+            elif len(parts) == 1:
+                return parts[0]
+            else:
+                return parallel(parts)
 
         get_edge_attributes = None
 
@@ -2910,7 +3091,16 @@ class pathcomp(object):
         Stat.collect_stat('pred_out_list', out_cg.symbol_to_pred)
 
         edges = du.get_edges(dfa)
-        get_edge_attributes = du.get_edge_attributes
+
+        ''' Each edge's attributes are requested once by the accepting-state
+        scan and again by the fragment-generation loop; compute them once. '''
+        edge_attr_cache = {}
+        def get_edge_attributes(dfa, edge, _get_attrs=du.get_edge_attributes):
+            try:
+                return edge_attr_cache[edge]
+            except KeyError:
+                edge_attr_cache[edge] = attrs = _get_attrs(dfa, edge)
+                return attrs
 
         in_edge_per_state = {}
         out_edge_per_state = {}
@@ -2996,8 +3186,8 @@ class pathcomp(object):
                 in_tagging_dic = {}
                 out_tagging_dic = {}
 
-                in_capture = drop
-                out_capture = drop
+                in_capture_parts = []
+                out_capture_parts = []
 
                 for edge in edges:
                     (src, src_num, dst, dst_num, pred, typ) = get_edge_attributes(dfa, edge)
@@ -3026,16 +3216,19 @@ class pathcomp(object):
 
                     if du.is_accepting(dfa, dst):
                         ords = du.get_accepting_exps(dfa, edge, dst)
+                        gate = match_tag(src_num, vfield) & pred
                         for i in ords:
 
-                            cap_frag = ((match_tag(src_num, vfield) & pred) >> pol_list[i])
+                            cap_frag = (gate >> pol_list[i])
                             if typ == __in__:
-                                in_capture += cap_frag
+                                in_capture_parts.append(cap_frag)
                                 in_cap_rules += 1
                             elif typ == __out__:
-                                out_capture += cap_frag
+                                out_capture_parts.append(cap_frag)
                                 out_cap_rules += 1
-                     
+
+                in_capture = build_parallel(in_capture_parts)
+                out_capture = build_parallel(out_capture_parts)
                 tagging_default = set([cls.__set_dead_state_tag__(du,dfa,vfield)])
                 in_tagging = QuerySwitch(vfield, in_tagging_dic, tagging_default)
                 out_tagging = QuerySwitch(vfield, out_tagging_dic, tagging_default)
@@ -3053,8 +3246,8 @@ class pathcomp(object):
                                 >> cls.__set_dead_state_tag__(du,dfa,vfield)) +
                                cls.__get_dead_state_pred__(du, dfa,vfield))
                 
-                in_table = in_default
-                out_table = out_default
+                in_table_parts = [in_default]
+                out_table_parts = [out_default]
                 for edge in edges:
                     (src, src_num, dst, dst_num, pred, typ) = get_edge_attributes(dfa, edge)
                     assert typ in [__in__, __out__]
@@ -3086,50 +3279,58 @@ class pathcomp(object):
                     if action_frag is not None:
                         tag_frag = (match_tag(src_num, vfield) & pred) >> action_frag
                         if typ == __in__:
-                            in_table += tag_frag
+                            in_table_parts.append(tag_frag)
                         elif typ == __out__:
-                            out_table += tag_frag
-                
+                            out_table_parts.append(tag_frag)
+
+                in_table = build_parallel(in_table_parts)
+                out_table = build_parallel(out_table_parts)
                 return ((in_table, out_table), accstates_to_pols)
 
             else:
                 """ Initialize tagging and capture policies. """
-                in_tagging = (((in_cg.get_unaffected_pred() &
+                in_tagging_parts = [(((in_cg.get_unaffected_pred() &
                                 ~(cls.__get_dead_state_pred__(du,dfa,vfield)))
                                >> cls.__set_dead_state_tag__(du, dfa, vfield)) +
-                              cls.__get_dead_state_pred__(du,dfa,vfield))
-                out_tagging = (((out_cg.get_unaffected_pred() &
+                              cls.__get_dead_state_pred__(du,dfa,vfield))]
+                out_tagging_parts = [(((out_cg.get_unaffected_pred() &
                                  ~(cls.__get_dead_state_pred__(du,dfa,vfield)))
                                 >> cls.__set_dead_state_tag__(du,dfa,vfield)) +
-                               cls.__get_dead_state_pred__(du, dfa, vfield))
-                in_capture = drop
-                out_capture = drop
+                               cls.__get_dead_state_pred__(du, dfa, vfield))]
+                in_capture_parts = []
+                out_capture_parts = []
                 """ Generate transition/accept rules from DFA """
                 for edge in edges:
                     (src, src_num, dst, dst_num, pred, typ) = get_edge_attributes(dfa, edge)
                     assert typ in [__in__, __out__]
+                    ''' The tag gate is shared by the tagging and capture
+                    fragments of this edge. '''
+                    gate = match_tag(src_num, vfield) & pred
                     if not du.is_dead(dfa, src):
-                        tag_frag = ((match_tag(src_num, vfield) & pred) >>
-                                    set_tag(dst_num, vfield))
+                        tag_frag = (gate >> set_tag(dst_num, vfield))
                         if typ == __in__:
-                            in_tagging += tag_frag
+                            in_tagging_parts.append(tag_frag)
                             in_tag_rules += 1
 
                         elif typ == __out__:
-                            out_tagging += tag_frag
+                            out_tagging_parts.append(tag_frag)
                             out_tag_rules += 1
 
                     if du.is_accepting(dfa, dst):
                         ords = du.get_accepting_exps(dfa, edge, dst)
                         for i in ords:
 
-                            cap_frag = ((match_tag(src_num, vfield) & pred) >> pol_list[i])
+                            cap_frag = (gate >> pol_list[i])
                             if typ == __in__:
-                                in_capture += cap_frag
+                                in_capture_parts.append(cap_frag)
                                 in_cap_rules += 1
                             elif typ == __out__:
-                                out_capture += cap_frag
+                                out_capture_parts.append(cap_frag)
                                 out_cap_rules += 1
+                in_tagging = build_parallel(in_tagging_parts)
+                out_tagging = build_parallel(out_tagging_parts)
+                in_capture = build_parallel(in_capture_parts)
+                out_capture = build_parallel(out_capture_parts)
                 return ((in_tagging, in_capture, out_tagging, out_capture), accstates_to_pols)
 
 
@@ -3168,11 +3369,18 @@ class common_dfa_utils(object):
 
 class dfa_utils(common_dfa_utils):
     """ Utilities to generate DFAs and access various properties. """
+    """ Single-entry DFA cache: path recompiles often present the same regex
+    list again, and DFA construction is deterministic in the expression
+    strings and symbol list. """
+    _dfa_cache_key = None
+    _dfa_cache = None
+
     @classmethod
     def init(cls, in_cg, out_cg):
         cls.in_cg = in_cg
         cls.out_cg = out_cg
-    
+        cls._sym_pred_typ = {}
+
     @classmethod
     def print_dfa(cls, d):
         """ Print a DFA object d. """
@@ -3258,36 +3466,34 @@ class dfa_utils(common_dfa_utils):
     @classmethod
     def get_symlist(re_exps):
         """ Given a list of re expressions, get the list of symbols at the
-        leaf-level. """
-        def get_symlist_single_re(r):
+        leaf-level. Walks each expression with an explicit stack, so deep
+        expressions neither recurse nor re-copy accumulated symbol lists. """
+        symlist = set([])
+        stack = list(re_exps)
+        while stack:
+            r = stack.pop()
             assert isinstance(r, re_deriv)
-            lst = []
             if isinstance(r, re_symbol):
-                lst = [r.char]
+                symlist.add(r.char)
             elif isinstance(r, re_epsilon) or isinstance(r, re_empty):
-                lst = []
+                pass
             elif isinstance(r, re_combinator):
-                lst = reduce(lambda acc, x: acc + get_symlist_single_re(x),
-                             r.re_list, [])
+                stack.extend(r.re_list)
             else:
                 raise TypeError
-            return lst
-
-        symlist = set([])
-        for r in re_exps:
-            syms_r = get_symlist_single_re(r)
-            reduce(lambda acc, x: acc.add(x), syms_r, symlist)
         return list(symlist)
 
     @classmethod
     def __dump_file__(cls, string, tmp_file):
-        f = open(tmp_file, 'w')
-        f.write(string)
-        f.close()
+        with open(tmp_file, 'w') as f:
+            f.write(string)
 
     @classmethod
     def __get_pred__(cls, dfa, edge):
-        """ Get predicate and atom type corresponding to an edge. """
+        """ Get predicate and atom type corresponding to an edge. The result
+        only depends on the edge symbol (each symbol belongs to exactly one
+        character generator), so it is computed once per symbol rather than
+        once per edge. """
         def __sym_in_class__(cg, sym):
             return sym in cg.symbol_to_pred
 
@@ -3311,11 +3517,17 @@ class dfa_utils(common_dfa_utils):
                     raise TypeError("Symbol can only be in or out typed.")
 
         edge_label = cls.get_edge_label(edge)
-        atoms_list = reduce(lambda a,x: a + x,
-                            cls.get_edge_atoms(dfa,edge),
-                            [])
+        try:
+            return cls._sym_pred_typ[edge_label]
+        except KeyError:
+            pass
+        atoms_list = []
+        for atoms in cls.get_edge_atoms(dfa, edge):
+            atoms_list.extend(atoms)
         (cg, typ) = __get_atoms_cg_typ__(atoms_list, edge_label)
-        return (cg.symbol_to_pred[edge_label], typ)
+        res = (cg.symbol_to_pred[edge_label], typ)
+        cls._sym_pred_typ[edge_label] = res
+        return res
    
     
     @classmethod
@@ -3346,13 +3558,13 @@ class dfa_utils(common_dfa_utils):
         if not symlist:
             symlist = (cls.in_cg.get_symlist() +
                        cls.out_cg.get_symlist())
+        cache_key = (tuple(r.re_string_repr() for r in re_exps),
+                     tuple(symlist))
+        if cache_key == cls._dfa_cache_key:
+            return cls._dfa_cache
         dfa = makeDFA_vector(re_exps, symlist)
-        cls.__dump_file__(dfa.dot_repr(), '/tmp/graph.dot')
-        leaf_preds = (cls.in_cg.get_leaf_preds() +
-                      cls.out_cg.get_leaf_preds())
-       
-        cls.__dump_file__(leaf_preds, '/tmp/symbols.txt')
-
+        cls._dfa_cache_key = cache_key
+        cls._dfa_cache = dfa
         return dfa
 
 
@@ -3369,17 +3581,26 @@ class ragel_dfa(object):
         return str(self.state_num) + ": " + str(self.edges)
 
 class ragel_dfa_utils(common_dfa_utils):
+    """ Single-entry DFA cache keyed on the generated lexer input, so
+    recompiles with an unchanged regex list skip the ragel fork/exec and dot
+    parsing entirely. """
+    _dfa_cache_key = None
+    _dfa_cache = None
+
     @classmethod
     def init(cls, in_cg, out_cg, edge_contraction_enabled):
         cls.edge_contraction_enabled = edge_contraction_enabled
         cls.in_cg = in_cg
         cls.out_cg = out_cg
+        cls._state_num_cache = {}
 
     @classmethod
-    def get_accepting_states(cls, data):
+    def get_accepting_states(cls, lines):
+        """ `lines` is the ragel dot output already split into lines, shared
+        with the edge extractors so the full text is only split once. """
         acc_seen = False
         res = []
-        for line in data.splitlines():
+        for line in lines:
             if 'node' in line and 'doublecircle' in line:
                 acc_seen = True
             elif acc_seen:
@@ -3416,11 +3637,11 @@ class ragel_dfa_utils(common_dfa_utils):
 
     
     @classmethod
-    def get_extended_edges_contracted(cls, output):
+    def get_extended_edges_contracted(cls, lines):
         res = []
         edge_ordinals = {}
         dfa_dict = {}
-        for line in output.splitlines():
+        for line in lines:
             if not '->' in line or 'IN' in line or 'main' in line:
                 continue
             
@@ -3447,19 +3668,20 @@ class ragel_dfa_utils(common_dfa_utils):
                         pass
 
             syms = [s.strip().replace('"','') for s in parts[0].split(',')]
+            pair_list = dfa_dict[(src, dst)]
             for s in syms:
                 if '..' in s:
                     index = s.index('..')
                     start = int(s[:index])
                     end = int(s[index + 2:])
-                    for i in range(start, end + 1):
+                    for i in xrange(start, end + 1):
                         edge = (src, i, dst)
-                        dfa_dict[(src,dst)].append( edge)
+                        pair_list.append(edge)
                         res.append(edge)
                         edge_ordinals[edge] = exp_list
                 else:
                     edge = (src, int(s), dst)
-                    dfa_dict[(src, dst)].append(edge)
+                    pair_list.append(edge)
                     res.append(edge)
                     edge_ordinals[edge] = exp_list
 
@@ -3531,11 +3753,11 @@ class ragel_dfa_utils(common_dfa_utils):
 
     
     @classmethod
-    def get_extended_edges(cls, output):
+    def get_extended_edges(cls, lines):
         res = []
         edge_ordinals = {}
-       
-        for line in output.splitlines():
+
+        for line in lines:
             if not '->' in line or 'IN' in line or 'main' in line:
                 continue
             
@@ -3564,9 +3786,9 @@ class ragel_dfa_utils(common_dfa_utils):
                     index = s.index('..')
                     start = int(s[:index])
                     end = int(s[index + 2:])
-                    for i in range(start, end + 1):
+                    for i in xrange(start, end + 1):
                         edge = (src, i, dst)
-                        res.append( edge)
+                        res.append(edge)
                         edge_ordinals[edge] = exp_list
                 else:
                     edge = (src, int(s), dst)
@@ -3578,20 +3800,30 @@ class ragel_dfa_utils(common_dfa_utils):
     def get_edges(cls, dfa):
         return dfa.edges
 
+    @classmethod
+    def __state_num__(cls, q):
+        """ Numeric value of a state, or None for the symbolic states the
+        edge contraction introduces. Parsed once per distinct state, since
+        every incident edge asks again. """
+        try:
+            return cls._state_num_cache[q]
+        except KeyError:
+            pass
+        try:
+            num = int(q)
+        except (TypeError, ValueError):
+            num = None
+        cls._state_num_cache[q] = num
+        return num
+
     @classmethod
     def get_edge_attributes(cls, dfa, edge, in_list=None, out_list=None):
         assert len(edge) == 3
         src = edge[0]
-        try:
-            src_num = int(src)
-        except:
-            src_num = None
-      
+        src_num = cls.__state_num__(src)
+
         dst = edge[2]
-        try:
-            dst_num = int(dst)
-        except:
-            dst_num = None
+        dst_num = cls.__state_num__(dst)
 
         if not in_list:
             in_list = cls.in_cg.symbol_to_pred
@@ -3633,16 +3865,18 @@ class ragel_dfa_utils(common_dfa_utils):
 
     @classmethod
     def regex_to_ragel_format(cls, re_list, use_fdd):
-        res = '%%{\n\tmachine pyretic;\n\talphtype unsigned int;\n'
+        parts = ['%%{\n\tmachine pyretic;\n\talphtype unsigned int;\n']
         for i in range(len(re_list)):
-            res += '\taction _%d {}\n' % i
-        
-        re_list_str = '\tmain := '
+            parts.append('\taction _%d {}\n' % i)
+
+        parts.append('\tmain := ')
+        re_strs = []
         for i,q in re_list:
             q_str = q if use_fdd else q.re_string_repr()
-            re_list_str += '((' + q_str + (') @_%d)|' %i)
-        res += re_list_str[:-1] + ';}%%\n%% write data;'
-        return res
+            re_strs.append('((' + q_str + (') @_%d)' % i))
+        parts.append('|'.join(re_strs))
+        parts.append(';}%%\n%% write data;')
+        return ''.join(parts)
 
     @classmethod
     def add_dead_edges(cls, edges, state_num):
@@ -3653,6 +3887,8 @@ class ragel_dfa_utils(common_dfa_utils):
         # get list of all predicates
         in_pred_symbols = cls.in_cg.symbol_to_pred.keys()
         out_pred_symbols = cls.out_cg.symbol_to_pred.keys()
+        in_sym_set = set(in_pred_symbols)
+        out_sym_set = set(out_pred_symbols)
         """ Determine edges currently in DFA, i.e., "non-dead" """
         for edge in edges:
             (s, p, d) = edge
@@ -3660,10 +3896,10 @@ class ragel_dfa_utils(common_dfa_utils):
                 state_edges[s].append(p)
             else:
                 state_edges[s] = [p]
-            if p in in_pred_symbols:
+            if p in in_sym_set:
                 assert s not in state_type or state_type[s] == "in"
                 state_type[s] = "in"
-            elif p in out_pred_symbols:
+            elif p in out_sym_set:
                 assert s not in state_type or state_type[s] == "out"
                 state_type[s] = "out"
             else:
@@ -3673,9 +3909,9 @@ class ragel_dfa_utils(common_dfa_utils):
         """ Add dead edges. """
         for s in state_edges.keys():
             if state_type[s] == "in":
-                all_symbols = set(copy.copy(in_pred_symbols))
+                all_symbols = in_sym_set
             else:
-                all_symbols = set(copy.copy(out_pred_symbols))
+                all_symbols = out_sym_set
             state_symbols = set(state_edges[s])
             remaining_symbols = all_symbols - state_symbols
             for sym in remaining_symbols:
@@ -3683,9 +3919,10 @@ class ragel_dfa_utils(common_dfa_utils):
         """ Add dead edges for accepting states (without outgoing transitions)
         too!! """
         dfa_states = set(state_edges.keys())
-        all_states = set(range(1, state_num))
+        all_states = set(xrange(1, state_num))
+        all_pred_symbols = in_pred_symbols + out_pred_symbols
         for s in all_states - dfa_states:
-            for sym in in_pred_symbols + out_pred_symbols:
+            for sym in all_pred_symbols:
                 edges.append((s, sym, dead))
 
     @classmethod
@@ -3696,9 +3933,7 @@ class ragel_dfa_utils(common_dfa_utils):
         global rt_write_log
         profile_enabled = True
         lex_gen_time = 0.0
-        lex_write_time = 0.0
         ragel_time = 0.0
-        graph_read_time = 0.0
         dfa_attr_gen_time = 0.0
         leaf_gen_time = 0.0
         dfa_gen_time = 0.0
@@ -3710,37 +3945,37 @@ class ragel_dfa_utils(common_dfa_utils):
         lex_input = cls.regex_to_ragel_format(re_list, use_fdd)
         lex_gen_time = time.time() - t_s
 
+        if (lex_input == cls._dfa_cache_key and
+            cls.edge_contraction_enabled == cls._dfa_cache[1]):
+            if profile_enabled:
+                pr.disable()
+            return cls._dfa_cache[0]
+
+        """ Pipe the lexer spec to ragel's stdin and read the dot graph off
+        its stdout directly, avoiding the /tmp/pyretic-regexes.txt and
+        /tmp/graph.dot disk round-trips on every recompilation. """
         t_s = time.time()
-        lex_input_file = '/tmp/pyretic-regexes.txt'
-        f = open(lex_input_file, 'w')
-        f.write(lex_input)
-        f.close()
-        lex_write_time = time.time() - t_s
-        try:
-            g = open('/tmp/graph.dot', 'w')
-            t_s = time.time()
-            subprocess.call(['ragel', '-V', lex_input_file], stdout=g)
-            g.close()
-            ragel_time = time.time() - t_s
-            t_s = time.time()
-            g = open('/tmp/graph.dot')
-            output = g.read()
-            g.close()
-            graph_read_time = time.time() - t_s
-        except subprocess.CalledProcessError as e:
-            
-            print "Error occured while running ragel"
-            print e.message
-            print e.returncode
-            print e.cmd
-            print e.output
+        proc = subprocess.Popen(['ragel', '-V'],
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE)
+        (output, _) = proc.communicate(lex_input)
+        ragel_time = time.time() - t_s
+        if proc.returncode != 0:
+            """ Fail fast: continuing with partial output only produces a
+            confusing failure later, in edge extraction. """
+            if profile_enabled:
+                pr.disable()
+            raise RuntimeError("ragel failed with return code %d" %
+                               proc.returncode)
 
         t_s = time.time()
-        (accepting_states, state_num) = cls.get_accepting_states(output)
+        output_lines = output.splitlines()
+        (accepting_states, state_num) = cls.get_accepting_states(output_lines)
         if cls.edge_contraction_enabled:
-            (edges, edge_ordinal) = cls.get_extended_edges_contracted(output)
+            (edges, edge_ordinal) = cls.get_extended_edges_contracted(
+                output_lines)
         else:
-            (edges, edge_ordinal) = cls.get_extended_edges(output)
+            (edges, edge_ordinal) = cls.get_extended_edges(output_lines)
         # Add missing edges going to dead states, if needed.
         cls.add_dead_edges(edges, state_num)
         dfa_attr_gen_time = time.time() - t_s
@@ -3750,12 +3985,18 @@ class ragel_dfa_utils(common_dfa_utils):
         t_s = time.time()
         leaf_preds = (cls.in_cg.get_leaf_preds() +
                       cls.out_cg.get_leaf_preds())
-       
-        dfa_utils.__dump_file__(leaf_preds, '/tmp/symbols.txt')
+
+        """ Per-process dump path, so concurrent controllers don't clobber
+        each other's symbol tables. """
+        symbols_file = os.path.join(tempfile.gettempdir(),
+                                    'pyretic-symbols-%d.txt' % os.getpid())
+        dfa_utils.__dump_file__(leaf_preds, symbols_file)
         leaf_gen_time = time.time() - t_s
 
         t_s = time.time()
         dfa = ragel_dfa(state_num, accepting_states, None, edges, edge_ordinal)
+        cls._dfa_cache_key = lex_input
+        cls._dfa_cache = (dfa, cls.edge_contraction_enabled)
         dfa_gen_time = time.time() - t_s
         if profile_enabled:
             pr.disable()
@@ -3766,9 +4007,7 @@ class ragel_dfa_utils(common_dfa_utils):
             rt_write_log.info(s.getvalue())
         rt_write_log.info("Times:\n" +
                           "lex_gen_time: %f\n" % lex_gen_time +
-                          "lex_write_time: %f\n" % lex_write_time +
                           "ragel_time: %f\n" % ragel_time +
-                          "graph_read_time: %f\n" % graph_read_time +
                           "dfa_attr_gen_time: %f\n" % dfa_attr_gen_time +
                           "leaf_gen_time: %f\n" % leaf_gen_time +
                           "dfa_gen_time: %f\n" % dfa_gen_time)
@@ -73,12 +73,26 @@ class re_deriv(object):
 
     def re_string_repr(self):
         """ This is the representation of the regular expression only depending
-        on the characters and combinators involved (no metadata). Each child
-        class should override this method."""
+        on the characters and combinators involved (no metadata). The result is
+        memoized: expression ASTs are never mutated after construction, and the
+        representation is otherwise rebuilt from the whole subtree on every
+        __hash__. Each child class overrides _re_string_repr instead."""
+        try:
+            return self._string_repr
+        except AttributeError:
+            self._string_repr = rep = self._re_string_repr()
+            return rep
+
+    def _re_string_repr(self):
+        """ Each child class should override this method. """
         raise NotImplementedError
 
     def __hash__(self):
-        return hash(self.re_string_repr())
+        try:
+            return self._hash
+        except AttributeError:
+            self._hash = h = hash(self.re_string_repr())
+            return h
 
     def __eq__(self, other):
         """ Each child class should override this method. """
@@ -151,7 +165,7 @@ class re_epsilon(re_base):
     def sort_key(self):
         return KEY_EPSILON
 
-    def re_string_repr(self):
+    def _re_string_repr(self):
         return "epsilon"
 
 class re_empty(re_base):
@@ -165,7 +179,7 @@ class re_empty(re_base):
     def sort_key(self):
         return KEY_EMPTY
 
-    def re_string_repr(self):
+    def _re_string_repr(self):
         return "^any"
 
 class re_symbol(re_base):
@@ -175,8 +189,9 @@ class re_symbol(re_base):
         self.char = char
 
     def __eq__(self, other):
-        return (isinstance(other, re_symbol) and
-                other.char == self.char)
+        return (other is self or
+                (isinstance(other, re_symbol) and
+                 other.char == self.char))
 
     def sort_key(self):
         return self.char
@@ -185,7 +200,7 @@ class re_symbol(re_base):
     def ml_ulex_repr(self):
         return self.char
 
-    def re_string_repr(self):
+    def _re_string_repr(self):
         #return "'%s'"%self.char
         return str(self.char)
 
@@ -230,10 +245,11 @@ class re_concat(re_combinator):
         super(re_concat, self).__init__([re1, re2])
 
     def __eq__(self, other):
-        return (isinstance(other, re_concat) and
-                self.re1 == other.re1 and
-                self.re2 == other.re2 and
-                self.re_list == other.re_list)
+        return (other is self or
+                (isinstance(other, re_concat) and
+                 self.re1 == other.re1 and
+                 self.re2 == other.re2 and
+                 self.re_list == other.re_list))
 
     def sort_key(self):
         return KEY_CONCAT
@@ -243,7 +259,7 @@ class re_concat(re_combinator):
                 self.re2.ml_ulex_repr() + ')')
 
 
-    def re_string_repr(self):
+    def _re_string_repr(self):
         return ('(' + self.re1.re_string_repr() + ').(' +
                 self.re2.re_string_repr() + ')')
 
@@ -257,8 +273,9 @@ class re_alter(re_combinator):
         super(re_alter, self).__init__(re_list)
 
     def __eq__(self, other):
-        return (isinstance(other, re_alter) and
-                self.re_list == other.re_list)
+        return (other is self or
+                (isinstance(other, re_alter) and
+                 self.re_list == other.re_list))
 
     def sort_key(self):
         return KEY_ALTER
@@ -268,7 +285,7 @@ class re_alter(re_combinator):
         return '(' + string.join(words, ')|(') + ')'
 
 
-    def re_string_repr(self):
+    def _re_string_repr(self):
         words = map(lambda x: x.re_string_repr(), self.re_list)
         return '(' + string.join(words, ')|(') + ')'
 
@@ -283,9 +300,10 @@ class re_star(re_combinator):
         super(re_star, self).__init__([re])
 
     def __eq__(self, other):
-        return (isinstance(other, re_star) and
-                self.re == other.re and
-                self.re_list == other.re_list)
+        return (other is self or
+                (isinstance(other, re_star) and
+                 self.re == other.re and
+                 self.re_list == other.re_list))
 
     def sort_key(self):
         return KEY_STAR
@@ -293,7 +311,7 @@ class re_star(re_combinator):
     def ml_ulex_repr(self):
         return '(' + self.re.ml_ulex_repr() + ')*'
 
-    def re_string_repr(self):
+    def _re_string_repr(self):
         return '(' + self.re.re_string_repr() + ')*'
 
     def __repr__(self):
@@ -305,8 +323,9 @@ class re_inters(re_combinator):
         super(re_inters, self).__init__(re_list)
 
     def __eq__(self, other):
-        return (isinstance(other, re_inters) and
-                self.re_list == other.re_list)
+        return (other is self or
+                (isinstance(other, re_inters) and
+                 self.re_list == other.re_list))
 
     def sort_key(self):
         return KEY_INTERS
@@ -315,7 +334,7 @@ class re_inters(re_combinator):
         words = map(lambda x: x.ml_ulex_repr(), self.re_list)
         return '(' + string.join(words, ')&(') + ')'
 
-    def re_string_repr(self):
+    def _re_string_repr(self):
         words = map(lambda x: x.re_string_repr(), self.re_list)
         return '(' + string.join(words, ')&(') + ')'
 
@@ -330,9 +349,10 @@ class re_negate(re_combinator):
         super(re_negate, self).__init__([re])
 
     def __eq__(self, other):
-        return (isinstance(other, re_negate) and
-                self.re == other.re and
-                self.re_list == other.re_list)
+        return (other is self or
+                (isinstance(other, re_negate) and
+                 self.re == other.re and
+                 self.re_list == other.re_list))
 
     def sort_key(self):
         return KEY_NEGATE
@@ -340,54 +360,53 @@ class re_negate(re_combinator):
     def ml_ulex_repr(self):
         return '~(' + self.re.ml_ulex_repr() + ')'
 
-    def re_string_repr(self):
+    def _re_string_repr(self):
         return '!(' + self.re.re_string_repr() + ')'
 
     def __repr__(self):
         return '!(' + repr(self.re) + ')'
 
 # Nullable function
-def nullable(r):
-    """ Return re_epsilon if a regular expression r is nullable, else
-    re_empty.
-
-    :param r: the regex which is tested.
-    :type r: re_deriv
-    """
-    def bool_to_re(b):
-        return re_epsilon() if b else re_empty()
-    def re_to_bool(r):
-        if isinstance(r, re_epsilon):
-            return True
-        elif isinstance(r, re_empty):
-            return False
-        else:
-            raise TypeError('re_to_bool expects re_epsilon or re_empty')
-    
-    assert isinstance(r, re_deriv)
+def __nullable_bool__(r):
+    """ Decide nullability of r as a boolean, memoized on the node: expression
+    ASTs are immutable, and the derivative of every concatenation re-asks this
+    question for its head on every symbol of DFA construction. """
+    try:
+        return r._nullable
+    except AttributeError:
+        pass
     if isinstance(r, re_epsilon):
-        return re_epsilon()
+        b = True
     elif isinstance(r, re_symbol):
-        return re_empty()
+        b = False
     elif isinstance(r, re_empty):
-        return re_empty()
+        b = False
     elif isinstance(r, re_concat):
-        f = lambda x: re_to_bool(nullable(x))
-        return bool_to_re(f(r.re1) and f(r.re2))
+        b = __nullable_bool__(r.re1) and __nullable_bool__(r.re2)
     elif isinstance(r, re_alter):
-        return bool_to_re(reduce(lambda acc, s: acc or re_to_bool(nullable(s)),
-                                 r.re_list,
-                                 False))
+        b = reduce(lambda acc, s: acc or __nullable_bool__(s),
+                   r.re_list, False)
     elif isinstance(r, re_star):
-        return re_epsilon()
+        b = True
     elif isinstance(r, re_inters):
-        return bool_to_re(reduce(lambda acc, s: acc and re_to_bool(nullable(s)),
-                                 r.re_list,
-                                 True))
+        b = reduce(lambda acc, s: acc and __nullable_bool__(s),
+                   r.re_list, True)
     elif isinstance(r, re_negate):
-        return bool_to_re(not re_to_bool(nullable(r.re)))
+        b = not __nullable_bool__(r.re)
     else:
         raise TypeError('unexpected type for nullable!')
+    r._nullable = b
+    return b
+
+def nullable(r):
+    """ Return re_epsilon if a regular expression r is nullable, else
+    re_empty.
+
+    :param r: the regex which is tested.
+    :type r: re_deriv
+    """
+    assert isinstance(r, re_deriv)
+    return re_epsilon() if __nullable_bool__(r) else re_empty()
 
 # Smart constructors, which enforce some useful representation invariants in the regular
 # expressions they construct. In particular, the RE is flattened out as much as
@@ -510,6 +529,31 @@ def smart_alter(r, s):
     else:
         return re_alter(re_nub(re_sort([r, s])))
 
+def smart_alter_list(re_list):
+    """ Smart alternation of a whole list of regular expressions.
+
+    Equivalent to folding smart_alter over re_list, but collects all the
+    alternands first and runs the invariant maintenance (flattening, sorting,
+    de-duplication) once, instead of re-sorting the accumulated list for every
+    element added.
+    """
+    alternands = []
+    for r in re_list:
+        if isinstance(r, re_alter):
+            alternands.extend(r.re_list)
+        elif is_empty(r):
+            continue
+        elif is_negated_empty(r):
+            return re_negate(re_empty())
+        else:
+            alternands.append(r)
+    if not alternands:
+        return re_empty()
+    alternands = re_nub(re_sort(alternands))
+    if len(alternands) == 1:
+        return alternands[0]
+    return re_alter(alternands)
+
 def smart_concat(r, s):
     """ Smart concatenation for regular expressions """
     if isinstance(r, re_concat):
@@ -624,6 +668,11 @@ def foldl(fun, re_list, init):
 def deriv(r, a):
     """ Derivative of a regular expression with respect to a single symbol
 
+    Derivatives are memoized per (node, symbol) on the node itself: nodes
+    are immutable once constructed, and the same sub-expressions recur both
+    across the states of one DFA construction and between the component and
+    vector DFA constructions.
+
     :param r: regular expression
     :type r: re_deriv
     :param a: a character with respect to which deriv is performed
@@ -631,6 +680,18 @@ def deriv(r, a):
     """
     assert isinstance(r, re_deriv)
     assert isinstance(a, re_symbol)
+    try:
+        cache = r._deriv_cache
+    except AttributeError:
+        cache = r._deriv_cache = {}
+    try:
+        return cache[a.char]
+    except KeyError:
+        res = __deriv_core__(r, a)
+        cache[a.char] = res
+        return res
+
+def __deriv_core__(r, a):
     asym = a.char
     if isinstance(r, re_empty):
         return re_empty()
@@ -756,13 +817,14 @@ class dfa_transition_table(object):
         tuples.
         """
         lst = []
-        for re in self.re_to_transitions:
-            for sym in self.re_to_transitions[re]:
-                lst.append((re, self.re_to_transitions[re][sym], sym))
+        for (re, tt_entry) in self.re_to_transitions.iteritems():
+            for (sym, dst) in tt_entry.iteritems():
+                lst.append((re, dst, sym))
         return lst
 
     def get_num_transitions(self):
-        return len(self.get_transitions())
+        return sum(len(tt_entry) for tt_entry in
+                   self.re_to_transitions.itervalues())
 
     def add_transition(self, state, symbol, new_state):
         """ Add a new transition to the DFA """
@@ -808,14 +870,14 @@ class dfa_transition_table(object):
                 g.add_edge(dot.Edge(src, dst, label=symbol))
 
     def __repr__(self):
-        out = ''
+        parts = []
         for state in self.re_to_transitions.keys():
-            out += "** Transitions from state " + repr(state) + '\n'
+            parts.append("** Transitions from state " + repr(state) + '\n')
             tt_entry = self.re_to_transitions[state]
             for edge in tt_entry.keys():
-                out += (repr(state) + "  ---> " + repr(edge) +
-                        " ---> " + repr(tt_entry[edge]) + '\n')
-        return out
+                parts.append(repr(state) + "  ---> " + repr(edge) +
+                             " ---> " + repr(tt_entry[edge]) + '\n')
+        return ''.join(parts)
 
 class re_transition_table(dfa_transition_table):
     """ The transition table for the DFA """
@@ -883,16 +945,18 @@ class re_transition_table(dfa_transition_table):
         return self.transition_to_metadata[q][s]
 
     def __repr__(self):
-        out = ''
+        parts = []
         for state in self.re_to_transitions.keys():
-            out += "** Transitions from state " + state.re_string_repr() + '\n'
+            parts.append("** Transitions from state " +
+                         state.re_string_repr() + '\n')
             tt_entry = self.re_to_transitions[state]
             for edge in tt_entry.keys():
-                out += (state.re_string_repr() + "  ---> " + repr(edge) +
-                        " ---> " + tt_entry[edge].re_string_repr() + '\n')
-                out += ("      on reading metadata: " +
-                        str(self.transition_to_metadata[state][edge]) + '\n')
-        return out
+                parts.append(state.re_string_repr() + "  ---> " + repr(edge) +
+                             " ---> " + tt_entry[edge].re_string_repr() + '\n')
+                parts.append("      on reading metadata: " +
+                             str(self.transition_to_metadata[state][edge]) +
+                             '\n')
+        return ''.join(parts)
 
 class dfa_state_table(object):
     """ A table of generic states in a DFA """
@@ -912,6 +976,12 @@ class dfa_state_table(object):
         self.re_map   = {}
         self.si = 0
         self.state_list = []
+        """ Per-state accepting/dead verdicts are memoized: the check
+        functions walk the (vector) state each time, and the compilation
+        loops ask about the same states once per incident edge. """
+        self._accepting_cache = {}
+        self._dead_cache = {}
+        self._dead_state = None
         for s in self.re_table:
             self.re_map[s] = self.si
             self.state_list.append(s)
@@ -926,6 +996,7 @@ class dfa_state_table(object):
         self.state_list.append(state)
         assert self.state_list[self.si] == state
         self.si += 1
+        self._dead_state = None
 
     def get_state_by_index(self, i):
         """ Given the numerical index of a state i, get the state. """
@@ -956,28 +1027,40 @@ class dfa_state_table(object):
             g.add_node(dot.Node(get_state_label(qi, q), shape=qshape))
 
     def __repr__(self):
-        out = ""
         sorted_states = sorted(self.re_table, key=lambda x: self.re_map[x])
-        for q in sorted_states:
-            out += '  ' + str(self.re_map[q]) + ': ' + repr(q) + '\n'
-        return out
+        return ''.join('  ' + str(self.re_map[q]) + ': ' + repr(q) + '\n'
+                       for q in sorted_states)
 
     def is_accepting(self, q):
         """ Return True if state `q` is an accepting state."""
-        return self.final_state_check_fun(q)
+        try:
+            return self._accepting_cache[q]
+        except KeyError:
+            res = self.final_state_check_fun(q)
+            self._accepting_cache[q] = res
+            return res
 
     def is_dead(self, q):
         """ Return if a state is dead. """
-        return self.dead_state_check_fun(q)
+        try:
+            return self._dead_cache[q]
+        except KeyError:
+            res = self.dead_state_check_fun(q)
+            self._dead_cache[q] = res
+            return res
 
     def get_dead_state(self):
-        """ Return the (one) dead state in the state table. """
+        """ Return the (one) dead state in the state table. Memoized until a
+        new state is added. """
+        if self._dead_state is not None:
+            return self._dead_state
         dead_states = []
         for q in self.re_table:
             if self.dead_state_check_fun(q):
                 dead_states.append(q)
         assert len(dead_states) <= 1
         if len(dead_states) == 1:
+            self._dead_state = dead_states[0]
             return dead_states[0]
         else:
             return None
@@ -1015,13 +1098,14 @@ class re_state_table(dfa_state_table):
 
 
     def __repr__(self):
-        out = ""
+        parts = []
         sorted_states = sorted(self.re_table, key=lambda x: self.re_map[x])
         for q in sorted_states:
-            out += '  ' + str(self.re_map[q]) + ': ' + q.re_string_repr() + '\n'
+            parts.append('  ' + str(self.re_map[q]) + ': ' +
+                         q.re_string_repr() + '\n')
             for exp in self.get_expressions(q):
-                out += '    --  ' + repr(exp) + '\n'
-        return out
+                parts.append('    --  ' + repr(exp) + '\n')
+        return ''.join(parts)
 
     def add_state(self, state):
         super(re_state_table, self).add_state(state)
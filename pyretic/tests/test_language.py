@@ -77,6 +77,40 @@ def test_covers_2():
 def test_covers_3():
     assert not match(inport=1).covers(identity)
 
+def test_eval_batch_matches_scalar_eval():
+    pkts = [Packet({'srcip':'10.0.0.1','switch':1}),
+            Packet({'srcip':'10.0.0.2','switch':1}),
+            Packet({'switch':2})]
+    for m in [match(srcip='10.0.0.1'),
+              match(srcip='10.0.0.0/24'),
+              match(switch=1),
+              match(switch=2,srcip='10.0.0.1')]:
+        assert m.eval_batch(pkts) == set(p for p in pkts if m.eval(p))
+
+def test_combinator_eval_batch_matches_scalar_eval():
+    pkts = [Packet({'srcip':'10.0.0.1','switch':1}),
+            Packet({'srcip':'10.0.0.2','switch':1}),
+            Packet({'switch':2})]
+    for pol in [match(switch=1) >> modify(srcip='10.0.0.3'),
+                match(switch=1) + match(srcip='10.0.0.2'),
+                ~match(switch=1),
+                match(switch=1) & match(srcip='10.0.0.1')]:
+        scalar = set()
+        for p in pkts:
+            scalar |= pol.eval(p)
+        assert pol.eval_batch(pkts) == scalar
+
+### CountBucket match bookkeeping tests ###
+
+def test_count_bucket_existing_rule_flag():
+    b = CountBucket()
+    b.add_match({'switch':1,'srcip':'10.0.0.1'}, 10, 3, existing_rule=True)
+    entry = next(iter(b.match_entries))
+    assert entry in b.matches_existing
+    b.clear_existing_rule_flag(entry)
+    assert entry in b.match_entries
+    assert entry not in b.matches_existing
+
 # TODO check this test
 def test_most_specific_prefix_matching():
     c1 = if_(
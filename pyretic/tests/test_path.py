@@ -807,6 +807,36 @@ def test_hook_compilation_2():
     assert hooks == ((match(path_tag=4) + match(path_tag=2))
                      >> FwdBucket())
 
+def test_new_symbol_skips_allocated():
+    """ Fresh symbol allocation must skip symbols already allocated globally,
+    using the flat global symbol set. """
+    cg_inst = __in_re_tree_gen__()
+    saved_token = re_tree_gen.token
+    saved_syms = set(re_tree_gen.global_sym_set)
+    try:
+        re_tree_gen.token = TOKEN_START_VALUE
+        re_tree_gen.global_sym_set.update([TOKEN_START_VALUE + 2,
+                                           TOKEN_START_VALUE + 4])
+        sym = cg_inst.__new_symbol__()
+        assert sym == TOKEN_START_VALUE + 6
+    finally:
+        re_tree_gen.token = saved_token
+        re_tree_gen.global_sym_set.clear()
+        re_tree_gen.global_sym_set.update(saved_syms)
+
+def test_CG_leaf_disjointness_after_split():
+    """ Stored leaf-level predicates must stay mutually disjoint even after a
+    split invalidates the memoized predicate union mid-call. """
+    cg_inst = __in_re_tree_gen__()
+    m1 = match(dstip='10.0.0.0/16')
+    m2 = match(srcip='1.2.3.4')
+    m3 = match(dstip='10.0.5.0/24', srcip='9.9.9.9')
+    for m in [m1, m2, m3]:
+        cg_inst.get_re_tree(m, atom(m).in_atom)
+    preds = cg_inst.pred_to_symbol.keys()
+    for i in range(len(preds)):
+        for j in range(i + 1, len(preds)):
+            assert not ne_inters(preds[i], preds[j])
 
 
 # Just in case: keep these here to run unit tests in vanilla python
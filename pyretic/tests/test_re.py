@@ -258,6 +258,20 @@ def test_dfa():
     assert not dfa3.accepts('b')
     assert dfa3.accepts('aaaa')
 
+def test_dfa_boolean_combinations():
+    """ Intersection and negation are solved at the DFA level from the re AST;
+    combining expressions must not blow up their string representations. """
+    a = re_symbol('a')
+    b = re_symbol('b')
+    r = (+(a | b)) & ~(a ^ b)
+    assert isinstance(r, re_inters)
+    # 'a' and 'ba' match; 'ab' is excluded by the negated intersectand.
+    assert isinstance(nullable(deriv(r, a)), re_epsilon)
+    assert isinstance(nullable(deriv(deriv(r, b), a)), re_epsilon)
+    assert isinstance(nullable(deriv(deriv(r, a), b)), re_empty)
+    # Representation stays linear in the operands; no textual rewriting.
+    assert r.re_string_repr() == '(!((a).(b)))&(((a)|(b))*)'
+
 def test_dot():
     a = re_symbol('a')
     b = re_symbol('b')